@@ -0,0 +1,46 @@
+"""Write throughput and startup load time of the SQLite state store.
+
+Usage: python benchmarks/bench_state_store.py [users]
+"""
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from storage import SQLiteStore  # noqa: E402
+
+
+def main(users):
+    path = os.path.join(tempfile.mkdtemp(), "state.db")
+    store = SQLiteStore(path)
+    store.start()
+
+    start = time.perf_counter()
+    for user_id in range(users):
+        store.put("trial_users", (user_id,))
+        store.put("subscriptions", (user_id, 1.7e9 + user_id))
+        store.put("credentials", (user_id, f"AC{user_id:032d}", "x" * 32, f"account {user_id}", 15.5))
+        store.put("purchased_numbers", (
+            user_id, f"+1204{user_id:07d}", f"PN{user_id:032d}", 1.7e9, f"AC{user_id:032d}", "x" * 32
+        ))
+    enqueued = time.perf_counter() - start
+    store.close()
+    durable = time.perf_counter() - start
+
+    writes = users * 4
+    print(f"{users} users, {writes} writes")
+    print(f"enqueue:  {enqueued:.3f}s ({writes / enqueued:,.0f} writes/s seen by handlers)")
+    print(f"durable:  {durable:.3f}s ({writes / durable:,.0f} writes/s committed)")
+
+    start = time.perf_counter()
+    store = SQLiteStore(path)
+    rows = sum(len(store.load(table)) for table in ("trial_users", "subscriptions", "credentials", "purchased_numbers"))
+    loaded = time.perf_counter() - start
+    store.close()
+    print(f"startup:  {loaded:.3f}s to load {rows} rows")
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 100_000)
@@ -0,0 +1,123 @@
+"""Webhook ingestion throughput with a local load generator.
+
+Posts synthetic message updates to the real webhook route and measures how
+many are accepted and dispatched per second. The bot's getMe call at
+startup is answered by a stand-in route on the same server, and updates go
+to a no-op handler so only ingestion and dispatch are measured. The load
+generator runs in a separate process; besides wall-clock throughput the
+server's own CPU time is reported, which is what one core can sustain.
+
+Usage: python benchmarks/bench_webhook.py [updates] [concurrency]
+"""
+import asyncio
+import json
+import multiprocessing
+import os
+import sys
+import time
+
+os.environ.setdefault("ADMIN_ID", "1")
+os.environ.setdefault("BOT_TOKEN", "1:bench")
+os.environ.setdefault("STATE_BACKEND", "memory")
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import aiohttp  # noqa: E402
+from aiohttp import web  # noqa: E402
+from telegram.ext import Application, TypeHandler  # noqa: E402
+
+import main  # noqa: E402
+
+PORT = 18080
+
+
+async def get_me(request):
+    return web.json_response({"ok": True, "result": {
+        "id": 1, "is_bot": True, "first_name": "bench", "username": "bench_bot"
+    }})
+
+
+def make_update(update_id):
+    user = {"id": 1000 + update_id % 1000, "is_bot": False, "first_name": "u"}
+    return json.dumps({"update_id": update_id, "message": {
+        "message_id": update_id, "date": 0, "text": "hi", "from": user,
+        "chat": {"id": user["id"], "type": "private"}
+    }}).encode()
+
+
+async def load(total, concurrency):
+    bodies = [make_update(i) for i in range(total)]
+    headers = {"X-Telegram-Bot-Api-Secret-Token": main.WEBHOOK_SECRET, "Content-Type": "application/json"}
+    queue = iter(bodies)
+    rejected = 0
+
+    async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=concurrency)) as session:
+        async def client():
+            nonlocal rejected
+            for body in queue:
+                async with session.post(f"http://127.0.0.1:{PORT}{main.WEBHOOK_PATH}", data=body, headers=headers) as resp:
+                    await resp.read()
+                    if resp.status != 200:
+                        rejected += 1
+
+        start = time.perf_counter()
+        await asyncio.gather(*(client() for _ in range(concurrency)))
+        elapsed = time.perf_counter() - start
+    print(f"accepted:  {total / elapsed:,.0f} updates/s ({rejected} rejected)")
+
+
+def load_process(total, concurrency, secret):
+    main.WEBHOOK_SECRET = secret
+    asyncio.run(load(total, concurrency))
+
+
+async def run(total, concurrency):
+    processed = 0
+    done = asyncio.Event()
+
+    async def count(update, context):
+        nonlocal processed
+        processed += 1
+        if processed == total:
+            done.set()
+
+    application = (
+        Application.builder()
+        .token(main.BOT_TOKEN)
+        .base_url(f"http://127.0.0.1:{PORT}/bot")
+        .application_class(main.OrderedApplication)
+        .concurrent_updates(main.UPDATE_BACKLOG)
+        .update_queue(main.UPDATE_QUEUE)
+        .build()
+    )
+    application.add_handler(TypeHandler(object, count))
+    main.application = application
+
+    app = web.Application()
+    app.router.add_post(main.WEBHOOK_PATH, main.webhook)
+    app.router.add_post(f"/bot{main.BOT_TOKEN}/getMe", get_me)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, "127.0.0.1", PORT).start()
+
+    async with application:
+        await application.start()
+        start = time.perf_counter()
+        cpu_start = time.process_time()
+        loader = multiprocessing.Process(target=load_process, args=(total, concurrency, main.WEBHOOK_SECRET))
+        loader.start()
+        await done.wait()
+        elapsed = time.perf_counter() - start
+        cpu = time.process_time() - cpu_start
+        await application.stop()
+    loader.join()
+    await runner.cleanup()
+
+    print(f"{total} updates, {concurrency} connections, json={main.json_loads.__module__}")
+    print(f"processed: {processed / elapsed:,.0f} updates/s wall clock")
+    print(f"server:    {processed / cpu:,.0f} updates/s per core of server CPU time")
+
+
+if __name__ == "__main__":
+    total = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    concurrency = int(sys.argv[2]) if len(sys.argv) > 2 else 64
+    asyncio.run(run(total, concurrency))
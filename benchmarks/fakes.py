@@ -0,0 +1,184 @@
+"""Local stand-ins for the Telegram Bot API and the Twilio REST API.
+
+Both servers run on one aiohttp app and answer only the endpoints main.py
+uses. Every request waits ``latency`` seconds (plus up to ``jitter``) and
+fails with probability ``error_rate``, so handlers can be measured against
+slow or flaky upstreams without real accounts.
+"""
+import asyncio
+import itertools
+import json
+import random
+import time
+
+from aiohttp import web
+from twilio.http.http_client import TwilioHttpClient
+
+TWILIO_HOSTS = {
+    "https://api.twilio.com": "",
+    "https://pricing.twilio.com": "/pricing",
+}
+
+
+class UpstreamProfile:
+    def __init__(self, latency=0.0, jitter=0.0, error_rate=0.0):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+
+    async def delay(self):
+        wait = self.latency + random.uniform(0, self.jitter)
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+    def fail(self):
+        return self.error_rate > 0 and random.random() < self.error_rate
+
+
+class FakeBotAPI:
+    """Answers the Bot API methods main.py calls and records what was sent."""
+
+    def __init__(self, token, profile=None):
+        self.token = token
+        self.profile = profile or UpstreamProfile()
+        self.calls = {}  # {method: count}
+        self.last_markup = {}  # {chat_id: reply_markup dict}
+        self._message_ids = itertools.count(1)
+
+    def add_routes(self, app):
+        app.router.add_post(f"/bot{self.token}/{{method}}", self.handle)
+
+    async def handle(self, request):
+        method = request.match_info["method"]
+        self.calls[method] = self.calls.get(method, 0) + 1
+        params = dict(await request.post()) if request.content_type != "application/json" else await request.json()
+        await self.profile.delay()
+        if method != "getMe" and self.profile.fail():
+            return web.json_response(
+                {"ok": False, "error_code": 429, "description": "Too Many Requests", "parameters": {"retry_after": 1}},
+                status=429
+            )
+
+        if method == "getMe":
+            result = {"id": 1, "is_bot": True, "first_name": "bench", "username": "bench_bot"}
+        elif method in ("sendMessage", "editMessageText", "editMessageReplyMarkup"):
+            chat_id = int(params.get("chat_id", 0))
+            markup = params.get("reply_markup")
+            if markup:
+                self.last_markup[chat_id] = json.loads(markup) if isinstance(markup, str) else markup
+            result = {
+                "message_id": int(params.get("message_id") or next(self._message_ids)),
+                "date": int(time.time()),
+                "chat": {"id": chat_id, "type": "private"},
+                "text": params.get("text", "")
+            }
+        else:
+            result = True
+        return web.json_response({"ok": True, "result": result})
+
+
+class FakeTwilio:
+    """Answers the Twilio REST endpoints main.py calls."""
+
+    def __init__(self, profile=None, numbers_per_page=20):
+        self.profile = profile or UpstreamProfile()
+        self.numbers_per_page = numbers_per_page
+        self.calls = {}  # {endpoint: count}
+        self._serial = itertools.count(1)
+
+    def add_routes(self, app):
+        prefix = "/2010-04-01/Accounts/{sid}"
+        routes = [
+            ("GET", prefix + ".json", "accounts", self.account),
+            ("GET", prefix + "/Balance.json", "balance", self.balance),
+            ("GET", prefix + "/AvailablePhoneNumbers/CA/Local.json", "available_numbers", self.available),
+            ("POST", prefix + "/IncomingPhoneNumbers.json", "incoming_create", self.create_number),
+            ("GET", prefix + "/IncomingPhoneNumbers.json", "incoming_list", self.list_numbers),
+            ("GET", prefix + "/IncomingPhoneNumbers/{pn}.json", "incoming_fetch", self.fetch_number),
+            ("DELETE", prefix + "/IncomingPhoneNumbers/{pn}.json", "incoming_delete", self.delete_number),
+            ("GET", prefix + "/Messages.json", "messages", self.messages),
+            ("GET", "/pricing/v1/PhoneNumbers/Countries/{country}", "pricing", self.pricing),
+        ]
+        for method, path, name, handler in routes:
+            app.router.add_route(method, path, self._wrap(name, handler))
+
+    def _wrap(self, name, handler):
+        async def wrapped(request):
+            self.calls[name] = self.calls.get(name, 0) + 1
+            await self.profile.delay()
+            if self.profile.fail():
+                return web.json_response(
+                    {"code": 20500, "message": "Injected failure", "status": 500}, status=500
+                )
+            return await handler(request)
+        return wrapped
+
+    def _page(self, key, items):
+        return web.json_response({
+            key: items, "uri": "", "first_page_uri": "", "next_page_uri": None,
+            "previous_page_uri": None, "page": 0, "page_size": len(items), "start": 0, "end": len(items)
+        })
+
+    async def account(self, request):
+        sid = request.match_info["sid"]
+        return web.json_response({"sid": sid, "friendly_name": f"Bench {sid[-4:]}", "status": "active"})
+
+    async def balance(self, request):
+        return web.json_response({"account_sid": request.match_info["sid"], "balance": "100.00", "currency": "USD"})
+
+    async def available(self, request):
+        area_code = request.query.get("AreaCode") or random.choice(["204", "416", "514", "604"])
+        numbers = [
+            {"phone_number": f"+1{area_code}{next(self._serial) % 10000000:07d}", "iso_country": "CA"}
+            for _ in range(min(int(request.query.get("PageSize", 20)), self.numbers_per_page))
+        ]
+        return self._page("available_phone_numbers", numbers)
+
+    def _number(self, sid, pn, phone_number=""):
+        return {
+            "sid": pn, "account_sid": sid, "phone_number": phone_number, "status": "in-use",
+            "uri": f"/2010-04-01/Accounts/{sid}/IncomingPhoneNumbers/{pn}.json"
+        }
+
+    async def create_number(self, request):
+        form = await request.post()
+        pn = f"PN{next(self._serial):032d}"
+        return web.json_response(self._number(request.match_info["sid"], pn, form.get("PhoneNumber", "")), status=201)
+
+    async def list_numbers(self, request):
+        return self._page("incoming_phone_numbers", [])
+
+    async def fetch_number(self, request):
+        return web.json_response(self._number(request.match_info["sid"], request.match_info["pn"]))
+
+    async def delete_number(self, request):
+        return web.Response(status=204)
+
+    async def messages(self, request):
+        message = {
+            "sid": f"SM{next(self._serial):032d}", "from": "+15550001111", "to": request.query.get("To", ""),
+            "body": "Your code is 123456", "date_sent": "Mon, 01 Jan 2024 00:00:00 +0000"
+        }
+        return self._page("messages", [message])
+
+    async def pricing(self, request):
+        return web.json_response({
+            "country": "Canada", "iso_country": request.match_info["country"],
+            "phone_number_prices": [{"number_type": "local", "base_price": "1.15", "current_price": "1.15"}],
+            "price_unit": "USD", "url": ""
+        })
+
+
+class LocalTwilioHttpClient(TwilioHttpClient):
+    """Twilio HTTP client that sends every request to the local fake server."""
+
+    def __init__(self, base_url, **kwargs):
+        super().__init__(**kwargs)
+        self.local_base_url = base_url
+
+    def request(self, method, url, *args, **kwargs):
+        for host, prefix in TWILIO_HOSTS.items():
+            if url.startswith(host):
+                url = self.local_base_url + prefix + url[len(host):]
+                break
+        return super().request(method, url, *args, **kwargs)
@@ -0,0 +1,207 @@
+"""Offline load test of the real bot handlers against local fakes.
+
+Starts the fake Bot API and Twilio servers from fakes.py, builds the real
+Application from main.py pointed at them and runs N simulated users through
+/start -> free trial -> /login -> credentials -> /buy -> purchase -> check
+messages. Each step is fed to Application.process_update and timed.
+
+Usage:
+    python benchmarks/loadtest.py --users 200 --twilio-latency 0.2
+    python benchmarks/loadtest.py --users 200 --save baseline.json
+    python benchmarks/loadtest.py --users 200 --compare baseline.json
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import logging
+import os
+import random
+import statistics
+import sys
+import time
+
+PORT = int(os.getenv("LOADTEST_PORT", "18081"))
+os.environ.setdefault("ADMIN_ID", "1")
+os.environ.setdefault("BOT_TOKEN", "1:loadtest")
+os.environ.setdefault("STATE_BACKEND", "memory")
+os.environ["BOT_API_URL"] = f"http://127.0.0.1:{PORT}/bot"
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from aiohttp import web  # noqa: E402
+from twilio.rest import Client  # noqa: E402
+
+import main  # noqa: E402
+from fakes import FakeBotAPI, FakeTwilio, LocalTwilioHttpClient, UpstreamProfile  # noqa: E402
+
+update_ids = itertools.count(1)
+
+
+def user_dict(user_id):
+    return {"id": user_id, "is_bot": False, "first_name": f"user{user_id}", "username": f"user{user_id}"}
+
+
+def command_update(user_id, text):
+    command = text.split()[0]
+    return {"update_id": next(update_ids), "message": {
+        "message_id": next(update_ids), "date": int(time.time()), "text": text,
+        "from": user_dict(user_id), "chat": {"id": user_id, "type": "private"},
+        "entities": [{"type": "bot_command", "offset": 0, "length": len(command)}]
+    }}
+
+
+def text_update(user_id, text):
+    return {"update_id": next(update_ids), "message": {
+        "message_id": next(update_ids), "date": int(time.time()), "text": text,
+        "from": user_dict(user_id), "chat": {"id": user_id, "type": "private"}
+    }}
+
+
+def callback_update(user_id, data):
+    return {"update_id": next(update_ids), "callback_query": {
+        "id": str(next(update_ids)), "from": user_dict(user_id), "chat_instance": str(user_id), "data": data,
+        "message": {
+            "message_id": next(update_ids), "date": int(time.time()), "text": "",
+            "chat": {"id": user_id, "type": "private"}
+        }
+    }}
+
+
+class LoadTest:
+    def __init__(self, application, bot_api):
+        self.application = application
+        self.bot_api = bot_api
+        self.latencies = {}  # {handler name: [seconds]}
+        self.skipped = 0
+
+    async def step(self, name, update):
+        start = time.perf_counter()
+        await self.application.process_update(update)
+        self.latencies.setdefault(name, []).append(time.perf_counter() - start)
+
+    def offered_number(self, user_id):
+        markup = self.bot_api.last_markup.get(user_id) or {}
+        for row in markup.get("inline_keyboard", []):
+            for button in row:
+                if button.get("callback_data", "").startswith("buy_"):
+                    return button["callback_data"][len("buy_"):]
+        return None
+
+    async def user_flow(self, user_id):
+        await self.step("start", command_update(user_id, "/start"))
+        await self.step("handle_plan_choice", callback_update(user_id, "free_1h"))
+        await self.step("login_command", command_update(user_id, "/login"))
+        await self.step("handle_login_prompt", callback_update(user_id, "login_prompt"))
+        await self.step("handle_twilio_credentials", text_update(user_id, f"AC{user_id:032x} {user_id:032x}"))
+        await self.step("buy_command", command_update(user_id, f"/buy {random.choice(main.VALID_CANADA_AREA_CODES)}"))
+
+        number = self.offered_number(user_id)
+        if number is None:
+            self.skipped += 1
+            return
+        await self.step("handle_number_purchase", callback_update(user_id, f"buy_{number}"))
+        await self.step("check_messages", callback_update(user_id, f"check_msg_{number}"))
+
+
+def percentile(values, pct):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))]
+
+
+def summarize(latencies, elapsed):
+    results = {}
+    for name, values in latencies.items():
+        results[name] = {
+            "count": len(values),
+            "mean_ms": statistics.fmean(values) * 1000,
+            "p50_ms": percentile(values, 50) * 1000,
+            "p95_ms": percentile(values, 95) * 1000,
+            "p99_ms": percentile(values, 99) * 1000,
+        }
+    total = sum(len(values) for values in latencies.values())
+    return {"elapsed_s": elapsed, "steps": total, "steps_per_s": total / elapsed, "handlers": results}
+
+
+def report(summary, baseline=None):
+    def delta(key, handler=None):
+        if baseline is None:
+            return ""
+        try:
+            old = baseline["handlers"][handler][key] if handler else baseline[key]
+            new = summary["handlers"][handler][key] if handler else summary[key]
+        except KeyError:
+            return ""
+        return f" ({(new - old) / old * 100:+.0f}%)" if old else ""
+
+    print(f"{summary['steps']} steps in {summary['elapsed_s']:.2f}s: "
+          f"{summary['steps_per_s']:,.1f} steps/s{delta('steps_per_s')}")
+    print(f"{'handler':<28}{'count':>7}{'p50 ms':>16}{'p95 ms':>16}{'p99 ms':>16}")
+    for name, stats in summary["handlers"].items():
+        print(
+            f"{name:<28}{stats['count']:>7}"
+            + "".join(f"{stats[key]:>9.1f}{delta(key, name):>7}" for key in ("p50_ms", "p95_ms", "p99_ms"))
+        )
+
+
+async def run(args):
+    bot_api = FakeBotAPI(main.BOT_TOKEN, UpstreamProfile(args.bot_latency, args.bot_jitter, args.bot_error_rate))
+    twilio = FakeTwilio(UpstreamProfile(args.twilio_latency, args.twilio_jitter, args.twilio_error_rate))
+    app = web.Application()
+    bot_api.add_routes(app)
+    twilio.add_routes(app)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, "127.0.0.1", PORT).start()
+
+    base_url = f"http://127.0.0.1:{PORT}"
+    main.make_twilio_client = lambda sid, token: Client(
+        sid, token, http_client=LocalTwilioHttpClient(base_url, timeout=main.TWILIO_TIMEOUT)
+    )
+    application = main.build_application()
+    main.application = application
+    main.SEND_QUEUE.start(application.bot)
+
+    loadtest = LoadTest(application, bot_api)
+    first_user = 100000
+    async with application:
+        start = time.perf_counter()
+        await asyncio.gather(*(loadtest.user_flow(first_user + i) for i in range(args.users)))
+        elapsed = time.perf_counter() - start
+    await runner.cleanup()
+
+    summary = summarize(loadtest.latencies, elapsed)
+    summary["users"] = args.users
+    summary["skipped_purchases"] = loadtest.skipped
+    summary["upstream_calls"] = {"telegram": bot_api.calls, "twilio": twilio.calls}
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+    report(summary, baseline)
+    print(f"users: {args.users}, purchases skipped (no number offered): {loadtest.skipped}")
+    print(f"twilio calls: {twilio.calls}")
+    print(f"telegram calls: {bot_api.calls}")
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(summary, f, indent=2)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--users", type=int, default=100)
+    parser.add_argument("--twilio-latency", type=float, default=0.1, help="seconds per Twilio request")
+    parser.add_argument("--twilio-jitter", type=float, default=0.05)
+    parser.add_argument("--twilio-error-rate", type=float, default=0.0)
+    parser.add_argument("--bot-latency", type=float, default=0.02, help="seconds per Bot API request")
+    parser.add_argument("--bot-jitter", type=float, default=0.01)
+    parser.add_argument("--bot-error-rate", type=float, default=0.0)
+    parser.add_argument("--save", help="write the results as JSON, e.g. for a baseline")
+    parser.add_argument("--compare", help="baseline JSON to compare against")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    logging.getLogger().setLevel(logging.WARNING)
+    asyncio.run(run(args))
@@ -1,11 +1,25 @@
+import time
+STARTUP_T0 = time.perf_counter()  # taken before the imports below so startup timing covers them
+
 import os
 import logging
 import asyncio
+import heapq
+import hashlib
+import hmac
+import importlib
+import itertools
+import json
 import random
-from datetime import datetime, timedelta
-from functools import wraps
+import re
+import signal
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from functools import partial, wraps
 from aiohttp import web
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.error import RetryAfter
 from telegram.ext import (
     Application,
     CommandHandler,
@@ -14,16 +28,89 @@ from telegram.ext import (
     MessageHandler,
     filters
 )
-from twilio.rest import Client
-from twilio.base.exceptions import TwilioRestException
+from twilio.base.exceptions import TwilioException, TwilioRestException
+from twilio.request_validator import RequestValidator
+from storage import open_store
+from metrics import Registry
+from users import UserStore
+
+try:
+    import orjson
+    json_loads = orjson.loads
+except ImportError:
+    json_loads = json.loads
 
 # Configuration
 BOT_TOKEN = os.getenv("BOT_TOKEN")
+BOT_API_URL = os.getenv("BOT_API_URL", "https://api.telegram.org/bot")
 ADMIN_ID = int(os.getenv("ADMIN_ID", "YOUR_ADMIN_ID"))
-TRIAL_USERS = set()
-SUBSCRIBED_USERS = {}
-USER_TWILIO_CREDS = {}  # {user_id: {'sid': '', 'token': '', 'account_name': '', 'balance': ''}}
-PURCHASED_NUMBERS = {}   # {user_id: {'number': '', 'sid': '', 'purchase_date': ''}}
+USERS = UserStore()  # trial flag, subscription expiry, Twilio credentials and number per user
+NUMBER_OWNERS = {}  # {number: user_id}
+
+# Public base URL Twilio posts inbound SMS to (Render sets RENDER_EXTERNAL_URL)
+PUBLIC_URL = os.getenv("PUBLIC_URL", os.getenv("RENDER_EXTERNAL_URL", "")).rstrip("/")
+SMS_WEBHOOK_PATH = "/sms"
+HEALTH_PATH = "/healthz"
+INBOX_SIZE = int(os.getenv("INBOX_SIZE", "20"))  # messages kept per number
+HISTORY_NUMBERS = int(os.getenv("HISTORY_NUMBERS", "50000"))  # numbers with a cached history
+HISTORY_PAGE_SIZE = 3  # messages per page in the Telegram UI
+
+# Update ingestion: "polling" or "webhook" (Telegram posts to PUBLIC_URL + WEBHOOK_PATH)
+UPDATE_MODE = os.getenv("UPDATE_MODE", "polling")
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/")
+# Stable across restarts, so updates Telegram posts during a cold start
+# (still signed with the secret set by the previous process) are accepted
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET") or hmac.new(
+    (BOT_TOKEN or "").encode(), b"webhook-secret", hashlib.sha256
+).hexdigest()
+UPDATE_BACKLOG = int(os.getenv("UPDATE_BACKLOG", "10000"))  # accepted but unfinished updates
+CONCURRENT_UPDATES = int(os.getenv("CONCURRENT_UPDATES", "256"))
+
+# Persistence (point STATE_DB at a persistent disk on Render)
+STATE_BACKEND = os.getenv("STATE_BACKEND", "sqlite")
+STATE_DB = os.getenv("STATE_DB", "state.db")
+STATE_STORE = open_store(STATE_BACKEND, STATE_DB)
+
+# Twilio calls run on a bounded thread pool so a slow round trip never blocks the event loop
+TWILIO_MAX_WORKERS = int(os.getenv("TWILIO_MAX_WORKERS", "32"))
+TWILIO_TIMEOUT = float(os.getenv("TWILIO_TIMEOUT", "15"))
+TWILIO_EXECUTOR = ThreadPoolExecutor(max_workers=TWILIO_MAX_WORKERS, thread_name_prefix="twilio")
+TWILIO_POOL_SIZE = int(os.getenv("TWILIO_POOL_SIZE", "256"))
+TWILIO_POOL_IDLE = float(os.getenv("TWILIO_POOL_IDLE", "900"))  # seconds
+INVENTORY_TTL = float(os.getenv("INVENTORY_TTL", "300"))  # seconds
+INVENTORY_FETCH_LIMIT = 20
+INVENTORY_REFRESH_CONCURRENCY = 4
+INVENTORY_IDLE = float(os.getenv("INVENTORY_IDLE", "900"))  # seconds a bucket nobody reads keeps being refreshed
+# Operator account for background inventory refreshes; without it buckets are only fetched on demand
+INVENTORY_SID = os.getenv("INVENTORY_SID")
+INVENTORY_TOKEN = os.getenv("INVENTORY_TOKEN")
+SEARCH_CONCURRENCY = 6  # area codes queried at once by /buy
+SEARCH_DEADLINE = float(os.getenv("SEARCH_DEADLINE", "8"))  # seconds
+SEARCH_WANTED = 10
+SEARCH_EDIT_INTERVAL = 1.0  # seconds between progress edits
+SEARCH_HEDGE_DELAY = 0.5  # seconds the first area code gets before fanning out
+BULK_MAX = 20  # numbers per /bulkbuy
+BULK_CONCURRENCY = 4  # purchases in flight per /bulkbuy
+NUMBER_PRICE = float(os.getenv("NUMBER_PRICE", "1.00"))  # fallback until Twilio pricing is known
+BALANCE_MAX_AGE = float(os.getenv("BALANCE_MAX_AGE", "120"))  # seconds a cached balance counts as fresh
+BALANCE_REFRESH_INTERVAL = 60
+BALANCE_REFRESH_CONCURRENCY = 8
+SEND_RATE = float(os.getenv("SEND_RATE", "30"))  # messages per second across all chats
+SEND_CHAT_INTERVAL = 1.0  # seconds between messages to the same chat
+SEND_CONCURRENCY = 16
+QUERY_CACHE_TTL = float(os.getenv("QUERY_CACHE_TTL", "3"))  # seconds a Check Messages / Number Info result is reused
+QUERY_CACHE_SIZE = 10000
+CALLBACK_RATE = float(os.getenv("CALLBACK_RATE", "0.5"))  # Twilio-backed button presses per second per user
+CALLBACK_BURST = 3
+LOGIN_OK_TTL = float(os.getenv("LOGIN_OK_TTL", "600"))  # seconds verified credentials skip Twilio
+LOGIN_FAIL_TTL = float(os.getenv("LOGIN_FAIL_TTL", "60"))  # seconds rejected credentials are refused locally
+LOGIN_CACHE_SIZE = 10000
+RELEASE_BACKOFF = 30  # seconds before the first retry of a failed number release
+RELEASE_MAX_BACKOFF = 3600
+RELEASE_CONCURRENCY = 4  # accounts released or reconciled at once
+RECONCILE_INTERVAL = float(os.getenv("RECONCILE_INTERVAL", "3600"))  # seconds between orphaned-number sweeps
+RECONCILE_GRACE = 600  # seconds a new purchase is left alone by the sweep
+MESSAGE_REVERT_DELAY = 5  # seconds a "no messages" notice stays before the message reverts
 
 logging.basicConfig(
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
@@ -40,6 +127,10 @@ PLANS = {
     "30d": {"label": "🟢 30 Day - 20$", "duration": 24*30, "price": 20}
 }
 
+PLANS_MARKUP = InlineKeyboardMarkup(
+    [[InlineKeyboardButton(plan["label"], callback_data=key)] for key, plan in PLANS.items()]
+)
+
 VALID_CANADA_AREA_CODES = [
     "204", "226", "236", "249", "250", "289", "306", "343", "365", "403",
     "416", "418", "431", "437", "438", "450", "506", "514", "519", "579",
@@ -47,6 +138,1050 @@ VALID_CANADA_AREA_CODES = [
     "780", "807", "819", "825", "867", "873", "902", "905"
 ]
 
+# Area codes by region and which regions border each other, for /buy fallbacks
+REGION_AREA_CODES = {
+    "BC": ["236", "250", "604", "672", "778"],
+    "AB": ["403", "587", "780", "825"],
+    "SK": ["306", "639"],
+    "MB": ["204", "431"],
+    "ON": ["226", "249", "289", "343", "365", "416", "437", "519", "613", "647", "705", "807", "905"],
+    "QC": ["418", "438", "450", "514", "579", "581", "819", "873"],
+    "ATL": ["506", "902"],
+    "NL": ["709"],
+    "NORTH": ["867"]
+}
+NEIGHBOR_REGIONS = {
+    "BC": ["AB", "NORTH"],
+    "AB": ["BC", "SK", "NORTH"],
+    "SK": ["AB", "MB"],
+    "MB": ["SK", "ON"],
+    "ON": ["QC", "MB"],
+    "QC": ["ON", "ATL", "NL"],
+    "ATL": ["QC", "NL"],
+    "NL": ["ATL", "QC"],
+    "NORTH": ["BC", "AB"]
+}
+AREA_CODE_REGION = {code: region for region, codes in REGION_AREA_CODES.items() for code in codes}
+
+def nearby_area_codes(area_code):
+    """Other codes in the same region first, then codes in bordering regions."""
+    region = AREA_CODE_REGION[area_code]
+    codes = [code for code in REGION_AREA_CODES[region] if code != area_code]
+    for neighbor in NEIGHBOR_REGIONS[region]:
+        codes.extend(REGION_AREA_CODES[neighbor])
+    return codes
+
+# Metrics, served at /metrics
+METRICS = Registry()
+HANDLER_LATENCY = METRICS.histogram("bot_handler_latency_seconds", "Handler latency", ("handler",))
+HANDLER_ERRORS = METRICS.counter("bot_handler_errors_total", "Exceptions raised by handlers", ("handler",))
+TWILIO_LATENCY = METRICS.histogram("bot_twilio_request_seconds", "Twilio API call latency", ("endpoint",))
+TWILIO_ERRORS = METRICS.counter("bot_twilio_errors_total", "Failed Twilio API calls", ("endpoint", "code"))
+EVENT_LOOP_LAG = METRICS.gauge("bot_event_loop_lag_seconds", "How late the event loop ran a 0.5s timer")
+STARTUP_SECONDS = METRICS.gauge("bot_startup_seconds", "Seconds from process start to each startup stage", ("stage",))
+STARTUP_STAGES = {}  # {stage: seconds since STARTUP_T0}
+
+def mark_startup(stage):
+    """Record (once) how long after process start ``stage`` was reached."""
+    if stage in STARTUP_STAGES:
+        return
+    elapsed = STARTUP_STAGES[stage] = time.perf_counter() - STARTUP_T0
+    STARTUP_SECONDS.set(elapsed, stage)
+    logger.info(f"Startup: {stage} after {elapsed:.3f}s")
+
+def instrument(func):
+    name = func.__name__
+
+    @wraps(func)
+    async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        start = time.perf_counter()
+        try:
+            return await func(update, context)
+        except Exception:
+            HANDLER_ERRORS.inc(name)
+            raise
+        finally:
+            HANDLER_LATENCY.observe(time.perf_counter() - start, name)
+    return wrapper
+
+async def measure_event_loop_lag(interval=0.5):
+    loop = asyncio.get_running_loop()
+    while True:
+        start = loop.time()
+        await asyncio.sleep(interval)
+        EVENT_LOOP_LAG.set(loop.time() - start - interval)
+
+# Twilio helpers
+def make_twilio_client(sid, token):
+    # twilio.rest and its HTTP stack are loaded on first use, not at startup
+    from twilio.rest import Client
+    from twilio.http.http_client import TwilioHttpClient
+    return Client(sid, token, http_client=TwilioHttpClient(timeout=TWILIO_TIMEOUT))
+
+class TwilioClientPool:
+    """LRU registry of Twilio clients keyed by (sid, token).
+
+    Each client keeps its own keep-alive HTTP session, so reusing it skips the
+    TLS handshake to api.twilio.com. Entries are evicted when the pool is full
+    or when they have been idle for longer than ``max_idle`` seconds.
+    """
+
+    def __init__(self, max_size=TWILIO_POOL_SIZE, max_idle=TWILIO_POOL_IDLE):
+        self.max_size = max_size
+        self.max_idle = max_idle
+        self._clients = OrderedDict()  # {(sid, token): (client, last_used)}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, sid, token):
+        now = time.monotonic()
+        self._evict_idle(now)
+        key = (sid, token)
+        entry = self._clients.get(key)
+        if entry is not None:
+            self.hits += 1
+            client = entry[0]
+            self._clients.move_to_end(key)
+        else:
+            self.misses += 1
+            client = make_twilio_client(sid, token)
+            while len(self._clients) >= self.max_size:
+                self._clients.popitem(last=False)
+                self.evictions += 1
+        self._clients[key] = (client, now)
+        return client
+
+    def invalidate(self, sid, token):
+        if self._clients.pop((sid, token), None) is not None:
+            self.evictions += 1
+
+    def _evict_idle(self, now):
+        while self._clients:
+            key, (client, last_used) = next(iter(self._clients.items()))
+            if now - last_used < self.max_idle:
+                break
+            del self._clients[key]
+            self.evictions += 1
+
+    def stats(self):
+        return {
+            'size': len(self._clients),
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions
+        }
+
+TWILIO_CLIENTS = TwilioClientPool()
+
+def get_twilio_client(user_id):
+    rec = USERS.get(user_id)
+    if rec is None or rec.sid is None:
+        raise KeyError(f"No Twilio credentials for user {user_id}")
+    return TWILIO_CLIENTS.get(rec.sid, rec.token)
+
+def twilio_status(error):
+    """HTTP status of a failed Twilio call, or None if no response came back.
+
+    Single-resource calls raise TwilioRestException; list calls raise a
+    plain TwilioException("Unable to fetch page", response).
+    """
+    if isinstance(error, TwilioRestException):
+        return error.status
+    if isinstance(error, TwilioException) and len(error.args) > 1:
+        return getattr(error.args[1], 'status_code', None)
+    return None
+
+async def twilio_call(func, *args, **kwargs):
+    """Run a blocking Twilio SDK call on the Twilio executor with a timeout."""
+    endpoint = f"{type(getattr(func, '__self__', None)).__name__}.{func.__name__}"
+    loop = asyncio.get_running_loop()
+    start = time.perf_counter()
+    try:
+        return await asyncio.wait_for(
+            loop.run_in_executor(TWILIO_EXECUTOR, partial(func, *args, **kwargs)),
+            timeout=TWILIO_TIMEOUT
+        )
+    except TwilioRestException as e:
+        TWILIO_ERRORS.inc(endpoint, e.code or e.status)
+        raise
+    except asyncio.TimeoutError:
+        TWILIO_ERRORS.inc(endpoint, "timeout")
+        raise
+    except Exception as e:
+        TWILIO_ERRORS.inc(endpoint, twilio_status(e) or "error")
+        raise
+    finally:
+        TWILIO_LATENCY.observe(time.perf_counter() - start, endpoint)
+
+def log_task_error(task):
+    """Done-callback for shared tasks, so a failure nobody awaited is still retrieved and logged."""
+    if not task.cancelled() and task.exception() is not None:
+        logger.warning(f"Background task {task.get_name()} failed: {task.exception()!r}")
+
+class NumberInventory:
+    """Cache of available Canadian numbers keyed by area code (or "any").
+
+    When INVENTORY_SID/TOKEN are configured a background task refreshes
+    buckets read in the last ``idle`` seconds ahead of expiry on that
+    account, so /buy can usually answer from memory, and stops once nobody
+    has searched for a while; if Twilio rejects the account (401) background
+    refreshes stop. Without them, or after that, a stale bucket is fetched
+    on demand with the searching user's own client. Customer credentials are
+    never used in the background. Numbers are removed as soon as they are
+    bought or Twilio reports them unavailable.
+    """
+
+    ANY = "any"
+
+    def __init__(self, ttl=INVENTORY_TTL, idle=INVENTORY_IDLE):
+        self.ttl = ttl
+        self.idle = idle
+        self._buckets = {}  # {bucket: {'numbers': [...], 'fetched': monotonic}}
+        self._inflight = {}  # {bucket: asyncio.Task}
+        self._requested = {}  # {bucket: monotonic time it was last read}
+        self._account = (INVENTORY_SID, INVENTORY_TOKEN) if INVENTORY_SID and INVENTORY_TOKEN else None
+
+    def _bucket(self, area_code):
+        return area_code or self.ANY
+
+    async def get(self, area_code, twilio_client):
+        bucket = self._bucket(area_code)
+        self._requested[bucket] = time.monotonic()
+        entry = self._buckets.get(bucket)
+        if entry is not None and time.monotonic() - entry['fetched'] < self.ttl:
+            return entry['numbers']
+        return await self._refresh(bucket, twilio_client)
+
+    def _refresh(self, bucket, twilio_client):
+        task = self._inflight.get(bucket)
+        if task is None:
+            task = asyncio.create_task(self._fetch(bucket, twilio_client), name=f"inventory refresh {bucket}")
+            self._inflight[bucket] = task
+            task.add_done_callback(lambda _: self._inflight.pop(bucket, None))
+            task.add_done_callback(log_task_error)
+        return asyncio.shield(task)
+
+    async def _fetch(self, bucket, twilio_client):
+        area_code = None if bucket == self.ANY else bucket
+        available_numbers = await twilio_call(
+            twilio_client.available_phone_numbers('CA').local.list,
+            area_code=area_code,
+            limit=INVENTORY_FETCH_LIMIT
+        )
+        numbers = [num.phone_number for num in available_numbers]
+        self._buckets[bucket] = {'numbers': numbers, 'fetched': time.monotonic()}
+        return numbers
+
+    def remove(self, number):
+        for entry in self._buckets.values():
+            if number in entry['numbers']:
+                entry['numbers'].remove(number)
+
+    async def refresh_due(self):
+        """Refresh recently read buckets that are past 3/4 of their TTL."""
+        now = time.monotonic()
+        self._requested = {b: t for b, t in self._requested.items() if now - t < self.idle}
+        account = self._account
+        if account is None or not self._requested:
+            return
+        stale = [
+            bucket for bucket in self._requested
+            if bucket not in self._inflight and (
+                bucket not in self._buckets
+                or now - self._buckets[bucket]['fetched'] >= self.ttl * 0.75
+            )
+        ]
+        if not stale:
+            return
+        twilio_client = TWILIO_CLIENTS.get(*account)
+        semaphore = asyncio.Semaphore(INVENTORY_REFRESH_CONCURRENCY)
+
+        async def refresh(bucket):
+            async with semaphore:
+                await self._refresh(bucket, twilio_client)
+
+        results = await asyncio.gather(*(refresh(bucket) for bucket in stale), return_exceptions=True)
+        errors = [e for e in results if isinstance(e, Exception)]
+        if any(twilio_status(e) == 401 for e in errors):
+            logger.error(f"Inventory account {account[0]} was rejected, stopping background refreshes")
+            TWILIO_CLIENTS.invalidate(*account)
+            self._account = None
+        elif errors:
+            logger.error(f"Inventory refresh failed for {len(errors)} of {len(stale)} buckets: {errors[0]}")
+
+    async def run(self):
+        if self._account is None:
+            logger.info("INVENTORY_SID/INVENTORY_TOKEN not set, number inventory is refreshed on demand only")
+            return
+        while self._account is not None:
+            await self.refresh_due()
+            await asyncio.sleep(self.ttl / 8)
+
+NUMBER_INVENTORY = NumberInventory()
+
+class MessageHistory:
+    """Recent SMS per number, newest last, with a high-water mark for refreshes.
+
+    Numbers bought with our SmsUrl are ``pushed``: sms_webhook adds every
+    message and refresh() never calls Twilio. For other numbers refresh()
+    only asks for messages sent after the newest one already seen, and
+    drops repeats by SID since Twilio's date filter is inclusive. Each
+    number keeps its last ``size`` messages and at most ``max_numbers``
+    histories are kept, least recently used out first; an evicted number
+    simply starts again from a full fetch.
+    """
+
+    def __init__(self, size=INBOX_SIZE, max_numbers=HISTORY_NUMBERS):
+        self.size = size
+        self.max_numbers = max_numbers
+        self._entries = OrderedDict()  # {number: {'messages': deque, 'sids': set, 'high_water': epoch, 'pushed': bool}}
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _entry(self, number):
+        entry = self._entries.get(number)
+        if entry is None:
+            entry = self._entries[number] = {
+                'messages': deque(maxlen=self.size), 'sids': set(), 'high_water': 0, 'pushed': False
+            }
+            if len(self._entries) > self.max_numbers:
+                self._entries.popitem(last=False)
+        else:
+            self._entries.move_to_end(number)
+        return entry
+
+    def track(self, number):
+        """Start an empty, complete history for a number that pushes to us."""
+        self._entry(number)['pushed'] = True
+
+    def drop(self, number):
+        self._entries.pop(number, None)
+
+    def add(self, number, msg):
+        self._append(self._entry(number), msg)
+
+    def _append(self, entry, msg):
+        if msg['sid'] in entry['sids']:
+            return
+        messages = entry['messages']
+        if len(messages) == messages.maxlen:
+            entry['sids'].discard(messages[0]['sid'])
+        messages.append(msg)
+        entry['sids'].add(msg['sid'])
+        entry['high_water'] = max(entry['high_water'], msg['date'])
+
+    def messages(self, number):
+        """Cached messages, newest last, without calling Twilio."""
+        entry = self._entries.get(number)
+        return entry['messages'] if entry is not None else ()
+
+    async def refresh(self, number, twilio_client):
+        entry = self._entry(number)
+        if entry['pushed']:
+            return entry['messages']
+        kwargs = {'to': number, 'limit': self.size}
+        if entry['high_water']:
+            kwargs['date_sent_after'] = datetime.fromtimestamp(entry['high_water'], timezone.utc)
+        fetched = await twilio_call(twilio_client.messages.list, **kwargs)
+        # Twilio lists newest first
+        for message in reversed(fetched):
+            sent = message.date_sent or message.date_created
+            self._append(entry, {
+                'sid': message.sid, 'from': message.from_, 'body': message.body,
+                'date': int(sent.timestamp()) if sent else int(time.time())
+            })
+        return entry['messages']
+
+MESSAGE_HISTORY = MessageHistory()
+
+class TwilioQueryCache:
+    """Single-flight Twilio reads with a short result cache.
+
+    Callers asking for the same key while a call is in flight share its
+    result, and a successful result is reused for ``ttl`` seconds. Errors
+    are not cached. Keys are (account SID, resource, operation); a number's
+    entries are invalidated when it is bought or replaced.
+    """
+
+    def __init__(self, ttl=QUERY_CACHE_TTL, max_entries=QUERY_CACHE_SIZE):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._results = OrderedDict()  # {key: (monotonic time, result)}
+        self._inflight = {}  # {key: asyncio.Task}
+
+    def get(self, key, factory):
+        """Return the cached result for ``key`` or await ``factory()`` once for everyone."""
+        cached = self._results.get(key)
+        if cached is not None and time.monotonic() - cached[0] < self.ttl:
+            return self._done(cached[1])
+        task = self._inflight.get(key)
+        if task is None:
+            task = asyncio.create_task(self._run(key, factory), name=f"twilio query {key}")
+            self._inflight[key] = task
+            task.add_done_callback(lambda _: self._inflight.pop(key, None))
+            task.add_done_callback(log_task_error)
+        return asyncio.shield(task)
+
+    @staticmethod
+    def _done(result):
+        future = asyncio.get_running_loop().create_future()
+        future.set_result(result)
+        return future
+
+    async def _run(self, key, factory):
+        result = await factory()
+        self._results[key] = (time.monotonic(), result)
+        self._results.move_to_end(key)
+        if len(self._results) > self.max_entries:
+            self._results.popitem(last=False)
+        return result
+
+    def invalidate(self, key):
+        self._results.pop(key, None)
+
+TWILIO_QUERIES = TwilioQueryCache()
+
+class CallbackLimiter:
+    """Per-user token bucket for buttons that end in a Twilio call."""
+
+    def __init__(self, rate=CALLBACK_RATE, burst=CALLBACK_BURST):
+        self.rate = rate
+        self.burst = burst
+        self._buckets = {}  # {user_id: (tokens, monotonic time)}
+
+    def allow(self, user_id):
+        now = time.monotonic()
+        tokens, refilled = self._buckets.get(user_id, (self.burst, now))
+        tokens = min(self.burst, tokens + (now - refilled) * self.rate)
+        if tokens < 1:
+            self._buckets[user_id] = (tokens, now)
+            return False
+        self._buckets[user_id] = (tokens - 1, now)
+        if len(self._buckets) > 10000:
+            # Drop users whose bucket has refilled anyway
+            full = (self.burst - 1) / self.rate
+            self._buckets = {u: b for u, b in self._buckets.items() if now - b[1] < full}
+        return True
+
+CALLBACK_LIMITER = CallbackLimiter()
+
+async def search_numbers(area_codes, twilio_client, on_progress=None, wanted=SEARCH_WANTED):
+    """Query several inventory buckets at once and collect up to ``wanted`` numbers.
+
+    The first code is queried alone; the rest only start once it has answered
+    or SEARCH_HEDGE_DELAY has passed, so a well-stocked first code costs one
+    lookup. ``on_progress`` is awaited with the numbers found so far whenever a
+    bucket adds new ones. Stops at ``wanted`` numbers or after SEARCH_DEADLINE.
+    """
+    semaphore = asyncio.Semaphore(SEARCH_CONCURRENCY)
+    first_answered = asyncio.Event()
+
+    async def probe(area_code, hedge):
+        if hedge:
+            try:
+                await asyncio.wait_for(first_answered.wait(), timeout=SEARCH_HEDGE_DELAY)
+            except asyncio.TimeoutError:
+                pass
+        async with semaphore:
+            return await NUMBER_INVENTORY.get(area_code, twilio_client)
+
+    found = []
+    tasks = [asyncio.create_task(probe(area_code, i > 0)) for i, area_code in enumerate(area_codes)]
+    try:
+        for next_done in asyncio.as_completed(tasks, timeout=SEARCH_DEADLINE):
+            try:
+                numbers = await next_done
+            except asyncio.TimeoutError:
+                break
+            except Exception as e:
+                logger.error(f"Number search failed for one area code: {e}")
+                numbers = []
+            new = [number for number in numbers if number not in found][:wanted - len(found)]
+            found.extend(new)
+            if len(found) >= wanted:
+                break
+            # Not enough yet, let the other area codes start
+            first_answered.set()
+            if new and on_progress is not None:
+                await on_progress(found)
+    finally:
+        # Shared inventory fetches are shielded and keep filling the cache
+        for task in tasks:
+            task.cancel()
+    return found
+
+class BalanceLedger:
+    """Locally tracked Twilio balance per account SID.
+
+    Balances are seeded at login, charged with the number price on every
+    purchase and re-synced with Twilio in the background for accounts used
+    recently. Charges made while a sync is in flight are re-applied on top of
+    the fetched value, and the difference to the local figure is logged as
+    drift.
+    """
+
+    ACTIVE_WINDOW = 3600
+
+    def __init__(self):
+        self._accounts = {}  # {sid: {'token', 'balance', 'price', 'synced', 'used', 'spent'}}
+
+    def seed(self, sid, token, balance, synced=True):
+        entry = self._accounts.setdefault(sid, {'price': None, 'spent': 0.0})
+        entry.update({
+            'token': token,
+            'balance': balance,
+            'synced': time.monotonic() if synced else float('-inf'),
+            'used': time.monotonic()
+        })
+
+    def price(self, sid):
+        entry = self._accounts.get(sid)
+        return entry['price'] if entry and entry['price'] is not None else NUMBER_PRICE
+
+    async def balance(self, sid, token):
+        """Return the cached balance, fetching it first if it is stale."""
+        entry = self._accounts.get(sid)
+        if entry is None or time.monotonic() - entry['synced'] >= BALANCE_MAX_AGE:
+            await self.sync(sid, token)
+            entry = self._accounts[sid]
+        entry['used'] = time.monotonic()
+        return entry['balance']
+
+    def charge(self, sid, amount):
+        entry = self._accounts[sid]
+        entry['balance'] -= amount
+        entry['spent'] += amount
+        return entry['balance']
+
+    async def sync(self, sid, token):
+        twilio_client = TWILIO_CLIENTS.get(sid, token)
+        entry = self._accounts.get(sid)
+        spent_before = entry['spent'] if entry else 0.0
+        fetched = float((await twilio_call(twilio_client.balance.fetch)).balance)
+
+        entry = self._accounts.get(sid)
+        if entry is None:
+            self.seed(sid, token, fetched)
+            entry = self._accounts[sid]
+        else:
+            balance = fetched - (entry['spent'] - spent_before)
+            drift = entry['balance'] - balance
+            if abs(drift) >= 0.01:
+                logger.info(f"Balance drift for {sid}: {drift:+.2f}")
+            entry['balance'] = balance
+            entry['synced'] = time.monotonic()
+
+        if entry['price'] is None:
+            entry['price'] = await self._fetch_price(twilio_client)
+
+    async def _fetch_price(self, twilio_client):
+        try:
+            country = await twilio_call(twilio_client.pricing.v1.phone_numbers.countries('CA').fetch)
+            for price in country.phone_number_prices:
+                if price['number_type'] == 'local':
+                    return float(price['current_price'])
+        except Exception as e:
+            logger.error(f"Failed to fetch number price: {e}")
+        return None
+
+    async def run(self):
+        """Re-sync every recently used account in one batch per interval."""
+        semaphore = asyncio.Semaphore(BALANCE_REFRESH_CONCURRENCY)
+
+        async def refresh(sid, token):
+            async with semaphore:
+                try:
+                    await self.sync(sid, token)
+                except Exception as e:
+                    logger.error(f"Balance sync failed for {sid}: {e}")
+
+        while True:
+            await asyncio.sleep(BALANCE_REFRESH_INTERVAL)
+            now = time.monotonic()
+            active = [
+                (sid, entry['token']) for sid, entry in self._accounts.items()
+                if now - entry['used'] < self.ACTIVE_WINDOW
+            ]
+            await asyncio.gather(*(refresh(sid, token) for sid, token in active))
+
+BALANCE_LEDGER = BalanceLedger()
+
+SID_PATTERN = re.compile(r"AC[0-9a-f]{32}")
+TOKEN_PATTERN = re.compile(r"[0-9a-f]{32}")
+
+class CredentialCache:
+    """Recent login outcomes so repeated attempts skip Twilio.
+
+    Credentials Twilio rejected are remembered for ``fail_ttl`` seconds and
+    verified ones (with their account name) for ``ok_ttl`` seconds. Entries
+    are keyed by the SID and a hash of the token, never the token itself.
+    """
+
+    def __init__(self, ok_ttl=LOGIN_OK_TTL, fail_ttl=LOGIN_FAIL_TTL, max_entries=LOGIN_CACHE_SIZE):
+        self.ok_ttl = ok_ttl
+        self.fail_ttl = fail_ttl
+        self.max_entries = max_entries
+        self._verified = OrderedDict()  # {key: (monotonic expiry, account_name)}
+        self._failed = OrderedDict()  # {key: monotonic expiry}
+
+    @staticmethod
+    def _key(sid, token):
+        return sid, hashlib.sha256(token.encode()).digest()
+
+    def _put(self, entries, key, value):
+        entries[key] = value
+        entries.move_to_end(key)
+        if len(entries) > self.max_entries:
+            entries.popitem(last=False)
+
+    def verified(self, sid, token):
+        """Account name if these credentials were verified recently, else None."""
+        entry = self._verified.get(self._key(sid, token))
+        if entry is None or entry[0] < time.monotonic():
+            return None
+        return entry[1]
+
+    def failed(self, sid, token):
+        expiry = self._failed.get(self._key(sid, token))
+        return expiry is not None and expiry >= time.monotonic()
+
+    def mark_verified(self, sid, token, account_name):
+        key = self._key(sid, token)
+        self._failed.pop(key, None)
+        self._put(self._verified, key, (time.monotonic() + self.ok_ttl, account_name))
+
+    def mark_failed(self, sid, token):
+        key = self._key(sid, token)
+        self._verified.pop(key, None)
+        self._put(self._failed, key, time.monotonic() + self.fail_ttl)
+
+CREDENTIAL_CACHE = CredentialCache()
+
+async def verify_credentials(sid, token):
+    """Return (account_name, balance) for working credentials.
+
+    Raises ValueError for malformed or recently rejected credentials without
+    calling Twilio; otherwise the account and balance are fetched at once
+    and the balance seeds the ledger.
+    """
+    if not SID_PATTERN.fullmatch(sid) or not TOKEN_PATTERN.fullmatch(token):
+        raise ValueError("malformed credentials")
+    if CREDENTIAL_CACHE.failed(sid, token):
+        raise ValueError("credentials rejected recently")
+    
+    account_name = CREDENTIAL_CACHE.verified(sid, token)
+    if account_name is not None:
+        return account_name, await BALANCE_LEDGER.balance(sid, token)
+    
+    twilio_client = TWILIO_CLIENTS.get(sid, token)
+    try:
+        account, balance = await asyncio.gather(
+            twilio_call(twilio_client.api.accounts(sid).fetch),
+            twilio_call(twilio_client.balance.fetch)
+        )
+    except TwilioRestException as e:
+        if e.status in (401, 403, 404):
+            CREDENTIAL_CACHE.mark_failed(sid, token)
+        raise
+    CREDENTIAL_CACHE.mark_verified(sid, token, account.friendly_name)
+    BALANCE_LEDGER.seed(sid, token, float(balance.balance))
+    return account.friendly_name, float(balance.balance)
+
+class ExpiryScheduler:
+    """Min-heap of subscription deadlines.
+
+    Entries are never removed in place: when a subscription is extended or
+    dropped, the old (deadline, user_id) entry stays in the heap and is skipped
+    once popped because it no longer matches the user's expiry.
+    """
+
+    MAX_SLEEP = 3600
+
+    def __init__(self):
+        self._heap = []  # [(deadline, user_id)]
+        self._wakeup = asyncio.Event()
+
+    def schedule(self, user_id, deadline):
+        heapq.heappush(self._heap, (deadline, user_id))
+        self._wakeup.set()
+
+    def pop_expired(self, now):
+        expired = []
+        while self._heap and self._heap[0][0] <= now:
+            deadline, user_id = heapq.heappop(self._heap)
+            rec = USERS.get(user_id)
+            if rec is not None and rec.expiry == deadline:
+                expired.append(user_id)
+        if len(self._heap) > 2 * USERS.subscribers + 1024:
+            self.rebuild()
+        return expired
+
+    def rebuild(self):
+        self._heap = [(deadline, user_id) for user_id, deadline in USERS.subscriptions()]
+        heapq.heapify(self._heap)
+
+    async def wait_next(self):
+        """Sleep until the earliest deadline or until a new one is scheduled."""
+        self._wakeup.clear()
+        timeout = self.MAX_SLEEP
+        if self._heap:
+            timeout = min(timeout, max(0, self._heap[0][0] - time.time()))
+        try:
+            await asyncio.wait_for(self._wakeup.wait(), timeout=timeout)
+        except asyncio.TimeoutError:
+            pass
+
+EXPIRY_SCHEDULER = ExpiryScheduler()
+
+class NumberReleaser:
+    """Durable background queue of numbers to release on Twilio.
+
+    Releases are persisted in the state store and retried with exponential
+    backoff until Twilio confirms the number is gone. Each pass groups due
+    releases by account and works through an account's numbers with one
+    pooled client. Every number the bot buys is also recorded until its
+    release is confirmed, and a periodic sweep queues any recorded number
+    no user owns any more, so a lost release never keeps costing money.
+    """
+
+    def __init__(self):
+        self._pending = {}  # {number_sid: {'account_sid', 'token', 'number', 'attempts', 'next_try'}}
+        self._bought = {}  # {number_sid: (account_sid, token, number, purchase_date)}
+        self._wakeup = asyncio.Event()
+
+    def __len__(self):
+        return len(self._pending)
+
+    def load(self, releases, bought):
+        for number_sid, account_sid, token, number, attempts in releases:
+            self._pending[number_sid] = {
+                'account_sid': account_sid, 'token': token, 'number': number,
+                'attempts': int(attempts), 'next_try': 0.0
+            }
+        for number_sid, account_sid, token, number, purchase_date in bought:
+            self._bought[number_sid] = (account_sid, token, number, int(purchase_date))
+
+    def record_purchase(self, account_sid, token, number_sid, number):
+        purchase_date = int(time.time())
+        self._bought[number_sid] = (account_sid, token, number, purchase_date)
+        STATE_STORE.put("bought_numbers", (number_sid, account_sid, token, number, purchase_date))
+
+    def enqueue(self, account_sid, token, number_sid, number):
+        if number_sid in self._pending:
+            return
+        self._pending[number_sid] = {
+            'account_sid': account_sid, 'token': token, 'number': number, 'attempts': 0, 'next_try': 0.0
+        }
+        STATE_STORE.put("number_releases", (number_sid, account_sid, token, number, 0))
+        self._wakeup.set()
+
+    def _done(self, number_sid):
+        self._pending.pop(number_sid, None)
+        STATE_STORE.delete("number_releases", number_sid)
+        if self._bought.pop(number_sid, None) is not None:
+            STATE_STORE.delete("bought_numbers", number_sid)
+
+    async def _release_account(self, number_sids):
+        first = self._pending[number_sids[0]]
+        twilio_client = TWILIO_CLIENTS.get(first['account_sid'], first['token'])
+        for number_sid in number_sids:
+            entry = self._pending[number_sid]
+            try:
+                await twilio_call(twilio_client.incoming_phone_numbers(number_sid).delete)
+            except TwilioRestException as e:
+                if e.status == 404:
+                    self._done(number_sid)  # Already released
+                    continue
+                self._retry(number_sid, entry, e)
+            except Exception as e:
+                self._retry(number_sid, entry, e)
+            else:
+                logger.info(f"Released number {entry['number']} ({number_sid})")
+                self._done(number_sid)
+
+    def _retry(self, number_sid, entry, error):
+        entry['attempts'] += 1
+        delay = min(RELEASE_MAX_BACKOFF, RELEASE_BACKOFF * 2 ** (entry['attempts'] - 1))
+        entry['next_try'] = time.monotonic() + delay * random.uniform(0.8, 1.2)
+        log = logger.error if entry['attempts'] >= 5 else logger.warning
+        log(f"Releasing {entry['number']} failed ({entry['attempts']} attempts), retrying in {delay:.0f}s: {error}")
+        STATE_STORE.put("number_releases", (
+            number_sid, entry['account_sid'], entry['token'], entry['number'], entry['attempts']
+        ))
+
+    async def release_due(self):
+        now = time.monotonic()
+        by_account = {}
+        for number_sid, entry in self._pending.items():
+            if entry['next_try'] <= now:
+                by_account.setdefault((entry['account_sid'], entry['token']), []).append(number_sid)
+        semaphore = asyncio.Semaphore(RELEASE_CONCURRENCY)
+        
+        async def release(number_sids):
+            async with semaphore:
+                await self._release_account(number_sids)
+        
+        await asyncio.gather(*(release(number_sids) for number_sids in by_account.values()))
+
+    def reconcile(self):
+        """Queue numbers the bot bought that no user owns any more.
+
+        Only SIDs in the durable record of our own purchases are considered,
+        so a wiped or fresh state store never releases anything.
+        """
+        owned = set()
+        for rec in USERS.records():
+            if rec.number_sid is not None:
+                owned.add(rec.number_sid)
+            for number_sid, _, _, _ in (rec.bulk_numbers or {}).values():
+                owned.add(number_sid)
+        # Leave purchases that may not be recorded on the user yet alone
+        cutoff = time.time() - RECONCILE_GRACE
+        for number_sid, (account_sid, token, number, purchase_date) in list(self._bought.items()):
+            if number_sid in owned or number_sid in self._pending or purchase_date > cutoff:
+                continue
+            logger.warning(f"Releasing orphaned number {number} on {account_sid}")
+            self.enqueue(account_sid, token, number_sid, number)
+
+    async def run(self):
+        last_reconcile = time.monotonic()
+        while True:
+            try:
+                await self.release_due()
+                if time.monotonic() - last_reconcile >= RECONCILE_INTERVAL:
+                    last_reconcile = time.monotonic()
+                    self.reconcile()
+            except Exception as e:
+                logger.error(f"Number release pass failed: {e}")
+            self._wakeup.clear()
+            next_try = min((entry['next_try'] for entry in self._pending.values()), default=None)
+            timeout = RECONCILE_INTERVAL - (time.monotonic() - last_reconcile)
+            if next_try is not None:
+                timeout = min(timeout, next_try - time.monotonic())
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=max(0, timeout))
+            except asyncio.TimeoutError:
+                pass
+
+NUMBER_RELEASER = NumberReleaser()
+
+class DeferredActions:
+    """Timer heap for delayed UI edits (reverts, auto-deletes).
+
+    Actions are keyed, usually by (chat_id, message_id); scheduling a key
+    again replaces its pending action. Like ExpiryScheduler, replaced and
+    cancelled entries stay in the heap and are skipped when popped, so
+    schedule() and cancel() are O(log n) / O(1) however many are pending.
+    Each due action runs as its own task so a slow Bot API call never
+    delays the next one.
+    """
+
+    def __init__(self):
+        self._heap = []  # [(deadline, seq, key)]
+        self._pending = {}  # {key: (seq, coroutine function)}
+        self._seq = itertools.count()
+        self._wakeup = asyncio.Event()
+
+    def __len__(self):
+        return len(self._pending)
+
+    def schedule(self, key, delay, action):
+        """Run ``action()`` (a coroutine function) in ``delay`` seconds."""
+        seq = next(self._seq)
+        deadline = time.monotonic() + delay
+        self._pending[key] = (seq, action)
+        heapq.heappush(self._heap, (deadline, seq, key))
+        if self._heap[0][1] == seq:
+            self._wakeup.set()
+
+    def cancel(self, key):
+        self._pending.pop(key, None)
+
+    def _pop_due(self, now):
+        due = []
+        while self._heap and self._heap[0][0] <= now:
+            _, seq, key = heapq.heappop(self._heap)
+            entry = self._pending.get(key)
+            if entry is not None and entry[0] == seq:
+                del self._pending[key]
+                due.append(entry[1])
+        if len(self._heap) > 2 * len(self._pending) + 1024:
+            self._heap = [entry for entry in self._heap if self._pending.get(entry[2], (None,))[0] == entry[1]]
+            heapq.heapify(self._heap)
+        return due
+
+    async def _run_action(self, action):
+        try:
+            await action()
+        except Exception as e:
+            logger.warning(f"Deferred action failed: {e}")
+
+    async def run(self):
+        while True:
+            for action in self._pop_due(time.monotonic()):
+                asyncio.create_task(self._run_action(action))
+            self._wakeup.clear()
+            timeout = max(0, self._heap[0][0] - time.monotonic()) if self._heap else None
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=timeout)
+            except asyncio.TimeoutError:
+                pass
+
+DEFERRED_ACTIONS = DeferredActions()
+
+class SendQueue:
+    """Outbound Telegram dispatcher for notifications and broadcasts.
+
+    Messages wait in a FIFO per chat, and a chat is handed to the workers
+    only once its per-chat minimum interval has passed, so a burst to one
+    chat never ties up workers that could serve other chats. Workers send
+    with bounded concurrency under a global token bucket (SEND_RATE msg/s).
+    A 429 pauses all workers for ``retry_after`` seconds and the message is
+    retried first in its chat.
+    """
+
+    MAX_ATTEMPTS = 5
+
+    def __init__(self, rate=SEND_RATE, chat_interval=SEND_CHAT_INTERVAL, concurrency=SEND_CONCURRENCY):
+        self.rate = rate
+        self.chat_interval = chat_interval
+        self.concurrency = concurrency
+        self._ready = asyncio.Queue()  # chat_ids that may receive their next message now
+        self._chats = {}  # {chat_id: deque([(text, kwargs, attempt)])}, only chats with messages waiting
+        self._pending = 0
+        self._tokens = rate
+        self._refilled = time.monotonic()
+        self._paused_until = 0.0
+        self._chat_next = {}  # {chat_id: monotonic time the chat may receive again}
+        self._bot = None
+        self._workers = []
+
+    def start(self, bot):
+        self._bot = bot
+        self._workers = [asyncio.create_task(self._worker()) for _ in range(self.concurrency)]
+
+    def send(self, chat_id, text, **kwargs):
+        self._pending += 1
+        messages = self._chats.get(chat_id)
+        if messages is not None:
+            messages.append((text, kwargs, 1))  # The chat is already scheduled
+            return
+        self._chats[chat_id] = deque([(text, kwargs, 1)])
+        self._schedule(chat_id)
+
+    def _schedule(self, chat_id):
+        delay = self._chat_next.get(chat_id, 0.0) - time.monotonic()
+        if delay > 0:
+            asyncio.get_running_loop().call_later(delay, self._ready.put_nowait, chat_id)
+        else:
+            self._ready.put_nowait(chat_id)
+
+    def depth(self):
+        return self._pending
+
+    def broadcast(self, chat_ids, text, **kwargs):
+        for chat_id in chat_ids:
+            self.send(chat_id, text, **kwargs)
+
+    async def _acquire(self):
+        while True:
+            now = time.monotonic()
+            self._tokens = min(self.rate, self._tokens + (now - self._refilled) * self.rate)
+            self._refilled = now
+            wait = max(self._paused_until - now, (1 - self._tokens) / self.rate)
+            if wait <= 0:
+                self._tokens -= 1
+                return
+            await asyncio.sleep(wait)
+
+    async def _worker(self):
+        while True:
+            chat_id = await self._ready.get()
+            messages = self._chats[chat_id]
+            text, kwargs, attempt = messages.popleft()
+            try:
+                await self._acquire()
+                now = time.monotonic()
+                self._chat_next[chat_id] = now + self.chat_interval
+                if len(self._chat_next) > 10000:
+                    self._chat_next = {c: t for c, t in self._chat_next.items() if t > now}
+                await self._bot.send_message(chat_id=chat_id, text=text, **kwargs)
+            except RetryAfter as e:
+                self._paused_until = max(self._paused_until, time.monotonic() + e.retry_after)
+                if attempt < self.MAX_ATTEMPTS:
+                    messages.appendleft((text, kwargs, attempt + 1))
+                    self._pending += 1
+                else:
+                    logger.error(f"Giving up on message to {chat_id} after {attempt} attempts")
+            except Exception as e:
+                logger.error(f"Failed to send message to {chat_id}: {e}")
+            finally:
+                self._pending -= 1
+                if messages:
+                    self._schedule(chat_id)
+                else:
+                    del self._chats[chat_id]
+
+SEND_QUEUE = SendQueue()
+
+# Time helpers, all user timestamps are integer UTC epoch seconds
+def format_epoch(ts):
+    return datetime.utcfromtimestamp(ts).strftime('%Y-%m-%d %H:%M:%S')
+
+def remaining_days_hours(expiry):
+    remaining = max(0, expiry - int(time.time()))
+    return remaining // 86400, remaining % 86400 // 3600
+
+# State persistence helpers
+def set_subscription(user_id, expiry):
+    USERS.set_expiry(user_id, expiry)
+    EXPIRY_SCHEDULER.schedule(user_id, expiry)
+    STATE_STORE.put("subscriptions", (user_id, expiry))
+
+def save_credentials(user_id):
+    rec = USERS.get(user_id)
+    STATE_STORE.put("credentials", (user_id, rec.sid, rec.token, rec.account_name, rec.balance))
+
+def save_purchased_number(user_id):
+    rec = USERS.get(user_id)
+    STATE_STORE.put("purchased_numbers", (
+        user_id, rec.number, rec.number_sid, rec.purchase_date) + rec.number_account)
+
+def save_bulk_number(user_id, number):
+    number_sid, purchase_date, account_sid, token = USERS.get(user_id).bulk_numbers[number]
+    STATE_STORE.put("bulk_numbers", (number, user_id, number_sid, purchase_date, account_sid, token))
+
+def number_client(rec, number):
+    """Pooled Twilio client for the account ``number`` was bought on."""
+    _, _, account_sid, token = rec.lookup_number(number)
+    return TWILIO_CLIENTS.get(account_sid, token)
+
+def load_state():
+    for (user_id,) in STATE_STORE.load("trial_users"):
+        USERS.record(user_id).trial_used = True
+    for user_id, expiry in STATE_STORE.load("subscriptions"):
+        USERS.set_expiry(user_id, int(expiry))
+    for user_id, sid, token, account_name, balance in STATE_STORE.load("credentials"):
+        USERS.set_credentials(user_id, sid, token, account_name, balance)
+        BALANCE_LEDGER.seed(sid, token, balance, synced=False)
+    # Rows saved before numbers recorded their account fall back to the current login
+    for user_id, number, sid, purchase_date, account_sid, token in STATE_STORE.load("purchased_numbers"):
+        rec = USERS.record(user_id)
+        USERS.set_number(user_id, number, sid, int(purchase_date), account_sid or rec.sid, token or rec.token)
+        NUMBER_OWNERS[number] = user_id
+    for number, user_id, sid, purchase_date, account_sid, token in STATE_STORE.load("bulk_numbers"):
+        rec = USERS.record(user_id)
+        USERS.add_bulk_number(user_id, number, sid, int(purchase_date), account_sid or rec.sid, token or rec.token)
+        NUMBER_OWNERS[number] = user_id
+    NUMBER_RELEASER.load(STATE_STORE.load("number_releases"), STATE_STORE.load("bought_numbers"))
+    EXPIRY_SCHEDULER.rebuild()
+    logger.info(
+        f"Loaded state: {USERS.subscribers} subscriptions, "
+        f"{USERS.credentials} credentials, {USERS.numbers} numbers"
+    )
+
 # Decorator to check subscription
 def check_subscription(func):
     @wraps(func)
@@ -58,14 +1193,12 @@ def check_subscription(func):
             return await func(update, context)
             
         # Check subscription
-        if user_id in SUBSCRIBED_USERS and SUBSCRIBED_USERS[user_id] > datetime.utcnow():
+        if USERS.is_active(user_id, time.time()):
             return await func(update, context)
         else:
-            buttons = [[InlineKeyboardButton(plan["label"], callback_data=key)] for key, plan in PLANS.items()]
-            markup = InlineKeyboardMarkup(buttons)
             await update.message.reply_text(
                 "⚠️ আপনার Subscription একটিভ নেই! বট ব্যবহার করতে Subscription নিন:",
-                reply_markup=markup
+                reply_markup=PLANS_MARKUP
             )
     return wrapper
 
@@ -73,25 +1206,21 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
     user_id = user.id
     
-    if user_id in SUBSCRIBED_USERS and SUBSCRIBED_USERS[user_id] > datetime.utcnow():
-        expiry_date = SUBSCRIBED_USERS[user_id]
-        remaining = expiry_date - datetime.utcnow()
-        days = remaining.days
-        hours = remaining.seconds // 3600
+    if USERS.is_active(user_id, time.time()):
+        expiry = USERS.get(user_id).expiry
+        days, hours = remaining_days_hours(expiry)
         
         await update.message.reply_text(
             f"স্বাগতম {user.first_name}!\n\n"
             f"✅ আপনার Subscription একটিভ আছে!\n"
-            f"⏳ মেয়াদ শেষ হবে: {expiry_date.strftime('%Y-%m-%d %H:%M:%S')}\n"
+            f"⏳ মেয়াদ শেষ হবে: {format_epoch(expiry)}\n"
             f"⏳ বাকি সময়: {days} দিন {hours} ঘন্টা\n\n"
             f"নতুন নাম্বার কিনতে /buy কমান্ড ব্যবহার করুন"
         )
     else:
-        buttons = [[InlineKeyboardButton(plan["label"], callback_data=key)] for key, plan in PLANS.items()]
-        markup = InlineKeyboardMarkup(buttons)
         await update.message.reply_text(
             "আপনার Subscriptions চালু নেই ♻️ চালু করার জন্য নিচের Subscription Choose করুন ✅",
-            reply_markup=markup
+            reply_markup=PLANS_MARKUP
         )
 
 async def handle_plan_choice(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -104,11 +1233,13 @@ async def handle_plan_choice(update: Update, context: ContextTypes.DEFAULT_TYPE)
     await query.message.delete()
 
     if choice == "free_1h":
-        if user_id in TRIAL_USERS:
+        rec = USERS.record(user_id)
+        if rec.trial_used:
             await query.message.reply_text("⚠️ আপনি একবার ফ্রি ট্রায়াল নিয়েছেন। দয়া করে পেইড প্ল্যান ব্যবহার করুন।")
             return
-        TRIAL_USERS.add(user_id)
-        SUBSCRIBED_USERS[user_id] = datetime.utcnow() + timedelta(hours=1)
+        rec.trial_used = True
+        STATE_STORE.put("trial_users", (user_id,))
+        set_subscription(user_id, int(time.time()) + 3600)
         await query.message.reply_text("✅ 1 ঘন্টার জন্য ফ্রি ট্রায়াল সক্রিয় করা হলো।")
         return
 
@@ -132,7 +1263,7 @@ async def handle_plan_choice(update: Update, context: ContextTypes.DEFAULT_TYPE)
             InlineKeyboardButton("Cancel ❌", callback_data=f"cancel|{user_id}")
         ]
     ]
-    await context.bot.send_message(chat_id=ADMIN_ID, text=notify_text, reply_markup=InlineKeyboardMarkup(buttons))
+    SEND_QUEUE.send(ADMIN_ID, notify_text, reply_markup=InlineKeyboardMarkup(buttons))
 
 async def handle_admin_decision(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
@@ -144,7 +1275,7 @@ async def handle_admin_decision(update: Update, context: ContextTypes.DEFAULT_TY
     if action == "approve":
         plan_key = data[2]
         plan = PLANS[plan_key]
-        SUBSCRIBED_USERS[user_id] = datetime.utcnow() + timedelta(hours=plan["duration"])
+        set_subscription(user_id, int(time.time()) + plan["duration"] * 3600)
         await context.bot.send_message(chat_id=user_id, text=f"✅ আপনার {plan['label']} Subscription চালু হয়েছে।")
         await query.edit_message_text(f"✅ {user_id} ইউজারের Subscription Approved.")
 
@@ -152,6 +1283,18 @@ async def handle_admin_decision(update: Update, context: ContextTypes.DEFAULT_TY
         await context.bot.send_message(chat_id=user_id, text="❌ আপনার Subscription অনুরোধ বাতিল করা হয়েছে।")
         await query.edit_message_text(f"❌ {user_id} ইউজারের Subscription বাতিল করা হয়েছে।")
 
+async def admin_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.effective_user.id != ADMIN_ID:
+        return
+    pool = TWILIO_CLIENTS.stats()
+    await update.message.reply_text(
+        f"📊 Twilio Client Pool\n\n"
+        f"🔆 Clients : {pool['size']}\n"
+        f"🔆 Hits : {pool['hits']}\n"
+        f"🔆 Misses : {pool['misses']}\n"
+        f"🔆 Evictions : {pool['evictions']}"
+    )
+
 @check_subscription
 async def login_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
@@ -183,30 +1326,33 @@ async def handle_twilio_credentials(update: Update, context: ContextTypes.DEFAUL
     
     try:
         # Test Twilio credentials
-        twilio_client = Client(sid, auth)
-        account = twilio_client.api.accounts(sid).fetch()
-        balance = float(twilio_client.balance.fetch().balance)
+        account_name, balance = await verify_credentials(sid, auth)
+        
+        # Drop the pooled client of the previous credentials
+        old = USERS.get(user.id)
+        if old and old.sid is not None and (old.sid, old.token) != (sid, auth):
+            TWILIO_CLIENTS.invalidate(old.sid, old.token)
         
         # Store credentials
-        USER_TWILIO_CREDS[user.id] = {
-            'sid': sid,
-            'token': auth,
-            'account_name': account.friendly_name,
-            'balance': balance
-        }
+        USERS.set_credentials(user.id, sid, auth, account_name, balance)
+        save_credentials(user.id)
         
         # Success message
         response = (
             f"🎉 𝐋𝐨𝐠 𝐈𝐧 𝐒𝐮𝐜𝐜𝐞𝐬𝐬𝐟𝐮𝐥🎉\n"
-            f"⭕ 𝗔𝗰𝗰𝗼𝘂𝗻𝘁 𝗡𝗮𝗺𝗲 : {account.friendly_name}\n"
+            f"⭕ 𝗔𝗰𝗰𝗼𝘂𝗻𝘁 𝗡𝗮𝗺𝗲 : {account_name}\n"
             f"⭕ 𝗔𝗰𝗰𝗼𝘂𝗻𝘁 𝗕𝗮𝗹𝗮𝗻𝗰𝗲 : ${balance:.2f}\n\n"
             f"বিঃদ্রঃ নাম্বার কিনার আগে ব্যালেন্স চেক করে নিবেন ♻️\n"
             f"Founded By 𝗠𝗿 𝗘𝘃𝗮𝗻 🍁"
         )
         await update.message.reply_text(response)
         
+    except ValueError as e:
+        logger.info(f"Login refused locally: {e}")
+        await update.message.reply_text("❌ লগইন ব্যর্থ! টোকেন সঠিক কিনা চেক করুন আবার চেষ্টা করুন")
     except Exception as e:
         logger.error(f"Twilio login failed: {e}")
+        TWILIO_CLIENTS.invalidate(sid, auth)
         await update.message.reply_text("❌ লগইন ব্যর্থ! টোকেন সঠিক কিনা চেক করুন আবার চেষ্টা করুন")
 
 @check_subscription
@@ -214,23 +1360,20 @@ async def subscription_status(update: Update, context: ContextTypes.DEFAULT_TYPE
     user = update.effective_user
     user_id = user.id
     
-    if user_id in SUBSCRIBED_USERS:
-        expiry_date = SUBSCRIBED_USERS[user_id]
-        remaining = expiry_date - datetime.utcnow()
-        days = remaining.days
-        hours = remaining.seconds // 3600
+    rec = USERS.get(user_id)
+    if rec is not None and rec.expiry:
+        expiry = rec.expiry
+        days, hours = remaining_days_hours(expiry)
         
         await update.message.reply_text(
             f"✅ আপনার Subscription একটিভ আছে!\n"
-            f"⏳ মেয়াদ শেষ হবে: {expiry_date.strftime('%Y-%m-%d %H:%M:%S')}\n"
+            f"⏳ মেয়াদ শেষ হবে: {format_epoch(expiry)}\n"
             f"⏳ বাকি সময়: {days} দিন {hours} ঘন্টা"
         )
     else:
-        buttons = [[InlineKeyboardButton(plan["label"], callback_data=key)] for key, plan in PLANS.items()]
-        markup = InlineKeyboardMarkup(buttons)
         await update.message.reply_text(
             "⚠️ আপনার Subscription একটিভ নেই! বট ব্যবহার করতে Subscription নিন:",
-            reply_markup=markup
+            reply_markup=PLANS_MARKUP
         )
 
 @check_subscription
@@ -238,12 +1381,13 @@ async def buy_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
     
     # Check if user has Twilio credentials
-    if user_id not in USER_TWILIO_CREDS:
+    rec = USERS.get(user_id)
+    if rec is None or rec.sid is None:
         await update.message.reply_text("❌ প্রথমে Twilio credentials লগইন করুন /login কমান্ড দিয়ে")
         return
     
     try:
-        twilio_client = Client(USER_TWILIO_CREDS[user_id]['sid'], USER_TWILIO_CREDS[user_id]['token'])
+        twilio_client = get_twilio_client(user_id)
         
         # Check area code if provided
         area_code = context.args[0] if context.args else None
@@ -251,34 +1395,45 @@ async def buy_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
             await update.message.reply_text("❌ ভুল Area Code! সঠিক 3-digit Canadian area code দিন")
             return
 
-        # Get available numbers from Twilio (now fetching 10 numbers)
-        available_numbers = twilio_client.available_phone_numbers('CA') \
-                                        .local \
-                                        .list(area_code=area_code, limit=10)  # Changed from 20 to 10
+        # Requested code (or the "any" bucket) first, then fan out to other codes
+        if area_code:
+            area_codes = [area_code] + nearby_area_codes(area_code)
+        else:
+            area_codes = [None] + random.sample(VALID_CANADA_AREA_CODES, len(VALID_CANADA_AREA_CODES))
+        
+        message = await update.message.reply_text("🔎 নাম্বার খোঁজা হচ্ছে...")
+        last_edit = time.monotonic()
+        
+        async def show_progress(numbers):
+            nonlocal last_edit
+            if time.monotonic() - last_edit < SEARCH_EDIT_INTERVAL:
+                return
+            last_edit = time.monotonic()
+            numbers_text = "\n".join([f"{i+1}. {num}" for i, num in enumerate(numbers)])
+            try:
+                await message.edit_text(f"🔎 নাম্বার খোঁজা হচ্ছে... ({len(numbers)}টি পাওয়া গেছে)\n\n{numbers_text}")
+            except Exception as e:
+                logger.warning(f"Search progress edit failed: {e}")
+        
+        numbers = await search_numbers(area_codes, twilio_client, on_progress=show_progress)
         
-        if not available_numbers:
-            await update.message.reply_text("❌ এই মুহূর্তে কোনো নাম্বার পাওয়া যাচ্ছে না। পরে আবার চেষ্টা করুন")
+        if not numbers:
+            await message.edit_text("❌ এই মুহূর্তে কোনো নাম্বার পাওয়া যাচ্ছে না। পরে আবার চেষ্টা করুন")
             return
         
         # Prepare number list
-        numbers = [num.phone_number for num in available_numbers]
         numbers_text = "\n".join([f"{i+1}. {num}" for i, num in enumerate(numbers)])
-        
-        message = await update.message.reply_text(
-            f"🇨🇦 উপলব্ধ কানাডা নাম্বার লিস্ট (১০টি):\n\n{numbers_text}\n\n"
-            "কোন নাম্বারটি কিনতে চান? নিচের বাটনে ক্লিক করুন:"
-        )
+        text = f"🇨🇦 উপলব্ধ কানাডা নাম্বার লিস্ট ({len(numbers)}টি):\n\n{numbers_text}\n\n"
+        if area_code and not any(num.startswith(f"+1{area_code}") for num in numbers):
+            text += f"ℹ️ {area_code} এরিয়া কোডে নাম্বার নেই, কাছাকাছি এরিয়া কোডের নাম্বার দেখানো হলো\n\n"
+        text += "কোন নাম্বারটি কিনতে চান? নিচের বাটনে ক্লিক করুন:"
         
         # Create buttons for each available number
         buttons = []
         for i, number in enumerate(numbers):
             buttons.append([InlineKeyboardButton(f"{i+1}. {number}", callback_data=f"buy_{number}")])
         
-        await context.bot.edit_message_reply_markup(
-            chat_id=update.effective_chat.id,
-            message_id=message.message_id,
-            reply_markup=InlineKeyboardMarkup(buttons)
-        )
+        await message.edit_text(text, reply_markup=InlineKeyboardMarkup(buttons))
 
     except TwilioRestException as e:
         logger.error(f"Twilio error: {e}")
@@ -287,6 +1442,36 @@ async def buy_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         logger.error(f"Error in buy command: {e}")
         await update.message.reply_text("❌ নাম্বার লিস্ট দেখাতে সমস্যা হয়েছে! আবার চেষ্টা করুন")
 
+async def purchase_number(user_id, twilio_client, number, price):
+    """Buy ``number`` for the user and return its SID.
+
+    Points the number's inbound SMS at our webhook, registers it for SMS
+    delivery and charges the balance ledger. Recording the number on the
+    user record is left to the caller.
+    """
+    create_kwargs = {'phone_number': number}
+    if PUBLIC_URL:
+        create_kwargs['sms_url'] = PUBLIC_URL + SMS_WEBHOOK_PATH
+        create_kwargs['sms_method'] = 'POST'
+    try:
+        purchased_number = await twilio_call(twilio_client.incoming_phone_numbers.create, **create_kwargs)
+    except TwilioRestException as e:
+        if e.code == 20404:
+            NUMBER_INVENTORY.remove(number)
+        raise
+    NUMBER_INVENTORY.remove(number)
+    NUMBER_RELEASER.record_purchase(twilio_client.username, twilio_client.password, purchased_number.sid, number)
+    
+    NUMBER_OWNERS[number] = user_id
+    TWILIO_QUERIES.invalidate((twilio_client.username, number, 'messages'))
+    if PUBLIC_URL:
+        MESSAGE_HISTORY.track(number)
+    
+    rec = USERS.get(user_id)
+    rec.balance = BALANCE_LEDGER.charge(rec.sid, price)
+    save_credentials(user_id)
+    return purchased_number.sid
+
 async def handle_number_purchase(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
@@ -295,36 +1480,33 @@ async def handle_number_purchase(update: Update, context: ContextTypes.DEFAULT_T
     number = query.data.split("_")[1]
     
     try:
-        twilio_client = Client(USER_TWILIO_CREDS[user_id]['sid'], USER_TWILIO_CREDS[user_id]['token'])
+        twilio_client = get_twilio_client(user_id)
+        rec = USERS.get(user_id)
+        had_number = rec.number is not None
         
-        # Check balance first
-        balance = float(twilio_client.balance.fetch().balance)
-        if balance < 1.00:
+        # Check balance first (from the ledger while it is fresh)
+        balance = await BALANCE_LEDGER.balance(rec.sid, rec.token)
+        price = BALANCE_LEDGER.price(rec.sid)
+        if balance < price:
             await query.message.reply_text(f"❌ আপনার Twilio একাউন্টে পর্যাপ্ত ব্যালেন্স নেই। বর্তমান ব্যালেন্স: ${balance:.2f}")
             return
         
-        # Delete old number if exists
-        if user_id in PURCHASED_NUMBERS:
-            try:
-                old_number_sid = PURCHASED_NUMBERS[user_id]['sid']
-                twilio_client.incoming_phone_numbers(old_number_sid).delete()
-                logger.info(f"Deleted old number SID: {old_number_sid}")
-            except Exception as e:
-                logger.error(f"Error deleting old number: {e}")
-        
         # Purchase new number
-        purchased_number = twilio_client.incoming_phone_numbers.create(phone_number=number)
+        number_sid = await purchase_number(user_id, twilio_client, number, price)
+        new_balance = rec.balance
         
-        # Store new number info
-        PURCHASED_NUMBERS[user_id] = {
-            'number': number,
-            'sid': purchased_number.sid,
-            'purchase_date': datetime.utcnow()
-        }
+        # The old number is released in the background, with retries, on the
+        # account it was bought on
+        if had_number:
+            NUMBER_RELEASER.enqueue(*rec.number_account, rec.number_sid, rec.number)
+            NUMBER_OWNERS.pop(rec.number, None)
+            MESSAGE_HISTORY.drop(rec.number)
+            TWILIO_QUERIES.invalidate((rec.number_account[0], rec.number, 'messages'))
+            TWILIO_QUERIES.invalidate((rec.number_account[0], rec.number_sid, 'fetch'))
         
-        # Update balance
-        new_balance = balance - 1.00
-        USER_TWILIO_CREDS[user_id]['balance'] = new_balance
+        # Store new number info
+        USERS.set_number(user_id, number, number_sid, int(time.time()), rec.sid, rec.token)
+        save_purchased_number(user_id)
         
         # Prepare response
         keyboard = [
@@ -336,14 +1518,14 @@ async def handle_number_purchase(update: Update, context: ContextTypes.DEFAULT_T
         response_text = (
             f"✅ নাম্বার সফলভাবে কেনা হয়েছে!\n\n"
             f"📞 নাম্বার: {number}\n"
-            f"💰 খরচ: $1.00\n"
+            f"💰 খরচ: ${price:.2f}\n"
             f"📊 নতুন ব্যালেন্স: ${new_balance:.2f}\n"
-            f"🕒 কেনার সময়: {datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S')}"
+            f"🕒 কেনার সময়: {format_epoch(rec.purchase_date)}"
         )
         
         # If old number existed, add info about deletion
-        if user_id in PURCHASED_NUMBERS:
-            response_text += "\n\nℹ️ আপনার পূর্বের নাম্বারটি অটোমেটিক ডিলিট করা হয়েছে"
+        if had_number:
+            response_text += "\n\nℹ️ আপনার পূর্বের নাম্বারটি অটোমেটিক ডিলিট করা হচ্ছে"
         
         await query.message.reply_text(
             response_text,
@@ -365,26 +1547,171 @@ async def handle_number_purchase(update: Update, context: ContextTypes.DEFAULT_T
         logger.error(f"Unexpected error: {str(e)}")
         await query.message.reply_text("❌ নাম্বার কেনার সময় অপ্রত্যাশিত সমস্যা হয়েছে! আবার চেষ্টা করুন")
 
+@check_subscription
+async def bulk_buy_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_id = update.effective_user.id
+    
+    rec = USERS.get(user_id)
+    if rec is None or rec.sid is None:
+        await update.message.reply_text("❌ প্রথমে Twilio credentials লগইন করুন /login কমান্ড দিয়ে")
+        return
+    
+    # /bulkbuy <count> [area_code]
+    count = context.args[0] if context.args else ""
+    area_code = context.args[1] if len(context.args or ()) > 1 else None
+    if not count.isdigit() or not 1 <= int(count) <= BULK_MAX:
+        await update.message.reply_text(f"❌ ব্যবহার: /bulkbuy <1-{BULK_MAX}> [area_code]")
+        return
+    count = int(count)
+    if area_code and area_code not in VALID_CANADA_AREA_CODES:
+        await update.message.reply_text("❌ ভুল Area Code! সঠিক 3-digit Canadian area code দিন")
+        return
+    
+    try:
+        twilio_client = get_twilio_client(user_id)
+        
+        # One balance check for the whole batch
+        balance = await BALANCE_LEDGER.balance(rec.sid, rec.token)
+        price = BALANCE_LEDGER.price(rec.sid)
+        if balance < price * count:
+            await update.message.reply_text(
+                f"❌ {count}টি নাম্বারের জন্য ${price * count:.2f} দরকার, বর্তমান ব্যালেন্স: ${balance:.2f}\n"
+                f"আপনি সর্বোচ্চ {int(balance // price) if price else 0}টি নাম্বার কিনতে পারবেন"
+            )
+            return
+        
+        if area_code:
+            area_codes = [area_code] + nearby_area_codes(area_code)
+        else:
+            area_codes = [None] + random.sample(VALID_CANADA_AREA_CODES, len(VALID_CANADA_AREA_CODES))
+        
+        message = await update.message.reply_text(f"🔎 {count}টি নাম্বার খোঁজা হচ্ছে...")
+        # Extra candidates replace numbers someone else buys first (20404)
+        candidates = deque(await search_numbers(area_codes, twilio_client, wanted=count + min(count, 10)))
+        if not candidates:
+            await message.edit_text("❌ এই মুহূর্তে কোনো নাম্বার পাওয়া যাচ্ছে না। পরে আবার চেষ্টা করুন")
+            return
+        
+        bought = []
+        failed = []  # [(number, reason)]
+        semaphore = asyncio.Semaphore(BULK_CONCURRENCY)
+        last_edit = time.monotonic()
+        
+        async def show_progress():
+            nonlocal last_edit
+            if time.monotonic() - last_edit < SEARCH_EDIT_INTERVAL:
+                return
+            last_edit = time.monotonic()
+            try:
+                await message.edit_text(f"⏳ কেনা হচ্ছে... ✅ {len(bought)} / ❌ {len(failed)} / মোট {count}")
+            except Exception as e:
+                logger.warning(f"Bulk progress edit failed: {e}")
+        
+        async def buy_one():
+            async with semaphore:
+                while candidates:
+                    number = candidates.popleft()
+                    try:
+                        number_sid = await purchase_number(user_id, twilio_client, number, price)
+                    except TwilioRestException as e:
+                        if e.code == 20404:
+                            continue  # Taken meanwhile, try the next candidate
+                        logger.error(f"Bulk purchase of {number} failed: {e.code} {e.msg}")
+                        failed.append((number, "অনুমতি নেই" if e.code == 21215 else e.msg))
+                    except Exception as e:
+                        logger.error(f"Bulk purchase of {number} failed: {e}")
+                        failed.append((number, "অপ্রত্যাশিত সমস্যা"))
+                    else:
+                        USERS.add_bulk_number(user_id, number, number_sid, int(time.time()), rec.sid, rec.token)
+                        save_bulk_number(user_id, number)
+                        bought.append(number)
+                    await show_progress()
+                    return
+                failed.append((None, "নাম্বার পাওয়া যায়নি"))
+        
+        await asyncio.gather(*(buy_one() for _ in range(count)))
+        
+        text = f"✅ {len(bought)}/{count}টি নাম্বার কেনা হয়েছে (খরচ: ${price * len(bought):.2f}, নতুন ব্যালেন্স: ${rec.balance:.2f})\n"
+        if bought:
+            text += "\n" + "\n".join(f"📞 {number}" for number in bought) + "\n"
+        if failed:
+            text += "\n❌ ব্যর্থ:\n" + "\n".join(f"{number or '-'}: {reason}" for number, reason in failed)
+        buttons = [[InlineKeyboardButton(f"📧 {number}", callback_data=f"check_msg_{number}")] for number in bought]
+        await message.edit_text(text, reply_markup=InlineKeyboardMarkup(buttons) if buttons else None)
+    
+    except TwilioRestException as e:
+        logger.error(f"Twilio error: {e}")
+        await update.message.reply_text(f"❌ Twilio এরর: {e.msg}")
+    except Exception as e:
+        logger.error(f"Error in bulk buy command: {e}")
+        await update.message.reply_text("❌ নাম্বার কেনার সময় অপ্রত্যাশিত সমস্যা হয়েছে! আবার চেষ্টা করুন")
+
+def render_message_page(number, messages, page):
+    """Text and keyboard for one page of ``messages`` (newest last), page 0 is the newest."""
+    pages = max(1, -(-len(messages) // HISTORY_PAGE_SIZE))
+    page = min(max(page, 0), pages - 1)
+    end = len(messages) - page * HISTORY_PAGE_SIZE
+    shown = [messages[i] for i in range(end - 1, max(end - HISTORY_PAGE_SIZE, 0) - 1, -1)]
+    
+    text = f"📨 মেসেজ ({number}) - পেজ {page + 1}/{pages}\n"
+    for msg in shown:
+        text += f"\n🕒 {format_epoch(msg['date'])}\nFrom: {msg['from']}\n{msg['body']}\n"
+    
+    nav = []
+    if page > 0:
+        nav.append(InlineKeyboardButton("◀️ নতুন", callback_data=f"msg_page_{number}_{page - 1}"))
+    if page < pages - 1:
+        nav.append(InlineKeyboardButton("পুরনো ▶️", callback_data=f"msg_page_{number}_{page + 1}"))
+    keyboard = [nav] if nav else []
+    keyboard.append([InlineKeyboardButton("🔄 Refresh", callback_data=f"check_msg_{number}")])
+    return text, InlineKeyboardMarkup(keyboard)
+
 async def check_messages(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
-    await query.answer()
     
     user_id = query.from_user.id
     number = query.data.split("_")[2]
     
+    if not CALLBACK_LIMITER.allow(user_id):
+        await query.answer("⏳ একটু অপেক্ষা করে আবার চেষ্টা করুন")
+        return
+    await query.answer()
+    
+    rec = USERS.get(user_id)
+    owned = rec.lookup_number(number) if rec is not None else None
+    if owned is None:
+        await query.message.reply_text("❌ এই নাম্বারটি আপনার কেনা নাম্বারের লিস্টে নেই")
+        return
+    
     try:
-        twilio_client = Client(USER_TWILIO_CREDS[user_id]['sid'], USER_TWILIO_CREDS[user_id]['token'])
+        # Only messages newer than the last one seen are fetched, and
+        # presses close together share one fetch
+        messages = await TWILIO_QUERIES.get(
+            (owned[2], number, 'messages'),
+            partial(MESSAGE_HISTORY.refresh, number, number_client(rec, number))
+        )
         
-        # Get recent messages for this number
-        messages = twilio_client.messages.list(to=number, limit=1)
+        # The /bulkbuy summary lists several numbers; answer it with a new
+        # message so its other buttons stay usable
+        buttons = query.message.reply_markup.inline_keyboard if query.message.reply_markup else ()
+        if sum((button.callback_data or "").startswith("check_msg_") for row in buttons for button in row) > 1:
+            if messages:
+                text, reply_markup = render_message_page(number, messages, 0)
+                await query.message.reply_text(text, reply_markup=reply_markup)
+            else:
+                await query.message.reply_text(f"❌ {number} নাম্বারে কোনো মেসেজ পাওয়া যায় নি")
+            return
         
+        pending_key = (query.message.chat_id, query.message.message_id)
         if messages:
-            # Show the latest message
-            msg = messages[0]
+            # Show the newest page (and drop a revert left by an earlier press)
+            DEFERRED_ACTIONS.cancel(pending_key)
+            text, reply_markup = render_message_page(number, messages, 0)
             await context.bot.edit_message_text(
                 chat_id=query.message.chat_id,
                 message_id=query.message.message_id,
-                text=f"📨 নতুন মেসেজ:\n\nFrom: {msg.from_}\n\n{msg.body}"
+                text=text,
+                reply_markup=reply_markup
             )
         else:
             # No messages found
@@ -394,39 +1721,68 @@ async def check_messages(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 text="❌ কোনো মেসেজ পাওয়া যায় নি"
             )
             
-            # Revert back after 5 seconds
-            await asyncio.sleep(5)
-            await context.bot.edit_message_text(
+            # Revert back after 5 seconds, a later press replaces the pending revert
+            DEFERRED_ACTIONS.schedule(pending_key, MESSAGE_REVERT_DELAY, partial(
+                context.bot.edit_message_text,
                 chat_id=query.message.chat_id,
                 message_id=query.message.message_id,
                 text=f"✅ নাম্বার: {number}\n\n"
                      "মেসেজ চেক করতে নিচের বাটনে ক্লিক করুন:",
                 reply_markup=query.message.reply_markup
-            )
+            ))
             
     except Exception as e:
         logger.error(f"Error checking messages: {e}")
         await query.message.reply_text("❌ মেসেজ চেক করার সময় সমস্যা হয়েছে!")
 
-async def number_info(update: Update, context: ContextTypes.DEFAULT_TYPE):
+async def message_page(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Older/newer pages of a number's history, served from the local cache."""
     query = update.callback_query
+    
+    user_id = query.from_user.id
+    _, _, number, page = query.data.split("_")
+    
+    if NUMBER_OWNERS.get(number) != user_id:
+        await query.answer("❌ এই নাম্বারটি আপনার কেনা নাম্বারের লিস্টে নেই", show_alert=True)
+        return
+    messages = MESSAGE_HISTORY.messages(number)
+    if not messages:
+        await query.answer("🔄 মেসেজ আবার চেক করুন")
+        return
+    
     await query.answer()
+    text, reply_markup = render_message_page(number, messages, int(page))
+    await query.edit_message_text(text, reply_markup=reply_markup)
+
+async def number_info(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
     
     user_id = query.from_user.id
     number = query.data.split("_")[2]
     
-    if user_id not in PURCHASED_NUMBERS or PURCHASED_NUMBERS[user_id]['number'] != number:
+    if not CALLBACK_LIMITER.allow(user_id):
+        await query.answer("⏳ একটু অপেক্ষা করে আবার চেষ্টা করুন")
+        return
+    await query.answer()
+    
+    rec = USERS.get(user_id)
+    owned = rec.lookup_number(number) if rec is not None else None
+    if owned is None:
         await query.message.reply_text("❌ এই নাম্বারটি আপনার কেনা নাম্বারের লিস্টে নেই")
         return
+    number_sid, purchase_date, account_sid, _ = owned
     
     try:
-        twilio_client = Client(USER_TWILIO_CREDS[user_id]['sid'], USER_TWILIO_CREDS[user_id]['token'])
-        number_details = twilio_client.incoming_phone_numbers(PURCHASED_NUMBERS[user_id]['sid']).fetch()
+        twilio_client = number_client(rec, number)
+        number_details = await TWILIO_QUERIES.get(
+            (account_sid, number_sid, 'fetch'),
+            partial(twilio_call, twilio_client.incoming_phone_numbers(number_sid).fetch)
+        )
         
         info_text = (
             f"📞 নাম্বার ডিটেইলস:\n\n"
             f"🔢 নাম্বার: {number}\n"
-            f"📅 কেনার তারিখ: {PURCHASED_NUMBERS[user_id]['purchase_date'].strftime('%Y-%m-%d %H:%M:%S')}\n"
+            f"📅 কেনার তারিখ: {format_epoch(purchase_date)}\n"
             f"🆔 SID: {number_details.sid}\n"
             f"🔗 URL: {number_details.uri}\n"
             f"🔄 সিঙ্ক স্ট্যাটাস: {number_details.status}"
@@ -443,45 +1799,152 @@ async def number_info(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await query.message.reply_text("❌ নাম্বার ইনফো দেখাতে সমস্যা হয়েছে!")
 
 async def check_expired_subscriptions(context: ContextTypes.DEFAULT_TYPE):
-    now = datetime.utcnow()
-    expired_users = []
-    
-    for user_id, expiry_date in list(SUBSCRIBED_USERS.items()):
-        if expiry_date <= now:
-            expired_users.append(user_id)
-            del SUBSCRIBED_USERS[user_id]
+    expired_users = EXPIRY_SCHEDULER.pop_expired(time.time())
+    for user_id in expired_users:
+        USERS.set_expiry(user_id, 0)
+        STATE_STORE.delete("subscriptions", user_id)
             
     for user_id in expired_users:
-        try:
-            buttons = [[InlineKeyboardButton(plan["label"], callback_data=key)] for key, plan in PLANS.items()]
-            markup = InlineKeyboardMarkup(buttons)
-            await context.bot.send_message(
-                chat_id=user_id,
-                text="⚠️ আপনার Subscription এক্সপায়ার্ড হয়েছে! বট ব্যবহার চালিয়ে যেতে Renew করুন:",
-                reply_markup=markup
-            )
-        except Exception as e:
-            logger.error(f"Failed to notify expired user {user_id}: {e}")
+        SEND_QUEUE.send(
+            user_id,
+            "⚠️ আপনার Subscription এক্সপায়ার্ড হয়েছে! বট ব্যবহার চালিয়ে যেতে Renew করুন:",
+            reply_markup=PLANS_MARKUP
+        )
 
 async def subscription_checker(context: ContextTypes.DEFAULT_TYPE):
     while True:
         await check_expired_subscriptions(context)
-        await asyncio.sleep(3600)  # Check every hour
+        await EXPIRY_SCHEDULER.wait_next()  # Wake at the next deadline
+
+class OrderedApplication(Application):
+    """Application that processes updates concurrently but keeps each user's
+    updates in arrival order, and counts webhook updates still in progress.
+
+    An update first waits for its user's earlier updates and only then for
+    one of the CONCURRENT_UPDATES slots, so a user with many queued updates
+    holds at most one slot. PTB's own concurrency limit is set to
+    UPDATE_BACKLOG and only bounds how many updates wait here.
+    """
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.backlog = 0  # incremented by webhook(), only used in webhook mode
+        self._user_locks = {}  # {user_id: [lock, holders]}
+        self._slots = asyncio.Semaphore(CONCURRENT_UPDATES)
+
+    async def _process_in_slot(self, update):
+        async with self._slots:
+            await super().process_update(update)
+
+    async def process_update(self, update):
+        try:
+            if isinstance(update, dict):
+                # Raw webhook payload, decoded here rather than on the accept path
+                try:
+                    update = Update.de_json(update, self.bot)
+                except Exception as e:
+                    logger.warning(f"Dropping malformed update: {e}")
+                    return
+            key = None
+            if isinstance(update, Update):
+                if update.effective_user:
+                    key = update.effective_user.id
+                elif update.effective_chat:
+                    key = update.effective_chat.id
+            if key is None:
+                return await self._process_in_slot(update)
+            entry = self._user_locks.setdefault(key, [asyncio.Lock(), 0])
+            entry[1] += 1
+            try:
+                async with entry[0]:
+                    await self._process_in_slot(update)
+            finally:
+                entry[1] -= 1
+                if not entry[1]:
+                    del self._user_locks[key]
+        finally:
+            if self.backlog:
+                self.backlog -= 1
+            mark_startup("first_update")
+
+# Shared with the Application once it is built, so webhook updates that
+# arrive while the bot is still warming up wait here instead of failing
+UPDATE_QUEUE = asyncio.Queue()
+STATE_LOADED = asyncio.Event()
+application = None  # set in main()
 
 async def webhook(request):
-    data = await request.json()
-    await application.update_queue.put(Update.de_json(data, application.bot))
+    token = request.headers.get("X-Telegram-Bot-Api-Secret-Token", "")
+    if not hmac.compare_digest(token, WEBHOOK_SECRET):
+        return web.Response(status=403)
+    backlog = application.backlog if application is not None else UPDATE_QUEUE.qsize()
+    if backlog >= UPDATE_BACKLOG:
+        return web.Response(status=503, headers={"Retry-After": "1"})
+    
+    try:
+        data = json_loads(await request.read())
+    except ValueError:
+        return web.Response(status=400)
+    if application is not None:
+        application.backlog += 1
+    UPDATE_QUEUE.put_nowait(data)
     return web.Response(text="ok")
 
-async def main():
-    global application
-    application = Application.builder().token(BOT_TOKEN).build()
+async def health(request):
+    return web.json_response({"status": "ready" if "ready" in STARTUP_STAGES else "warming"})
+
+async def sms_webhook(request):
+    # Numbers are only known once the saved state is loaded
+    await STATE_LOADED.wait()
+    form = await request.post()
+    params = dict(form)
+    number = params.get('To')
+    rec = USERS.get(NUMBER_OWNERS.get(number))
+    owned = rec.lookup_number(number) if rec is not None else None
+    if owned is None:
+        return web.Response(status=404)
+    user_id = rec.user_id
+    
+    # Twilio signs with the token of the account the number lives on,
+    # which need not be the owner's current login
+    validator = RequestValidator(owned[3])
+    signature = request.headers.get('X-Twilio-Signature', '')
+    if not validator.validate(PUBLIC_URL + SMS_WEBHOOK_PATH, params, signature):
+        logger.warning(f"Rejected inbound SMS with bad signature for {number}")
+        return web.Response(status=403)
+    
+    msg = {
+        'sid': params.get('MessageSid', ''), 'from': params.get('From', ''),
+        'body': params.get('Body', ''), 'date': int(time.time())
+    }
+    MESSAGE_HISTORY.add(number, msg)
+    
+    SEND_QUEUE.send(user_id, f"📨 নতুন মেসেজ:\n\n📞 নাম্বার: {number}\nFrom: {msg['from']}\n\n{msg['body']}")
+    
+    return web.Response(text="<Response/>", content_type="text/xml")
+
+def build_application():
+    # Handlers await Twilio off-loop, so let other users' updates run meanwhile;
+    # OrderedApplication applies CONCURRENT_UPDATES after per-user ordering
+    application = (
+        Application.builder()
+        .token(BOT_TOKEN)
+        .base_url(BOT_API_URL)
+        .application_class(OrderedApplication)
+        .concurrent_updates(UPDATE_BACKLOG)
+        .update_queue(UPDATE_QUEUE)
+        .build()
+    )
+    # Updates buffered during warm-up count towards the backlog too
+    application.backlog = UPDATE_QUEUE.qsize()
     
     # Command handlers
     application.add_handler(CommandHandler("start", start))
     application.add_handler(CommandHandler("login", login_command))
     application.add_handler(CommandHandler("status", subscription_status))
     application.add_handler(CommandHandler("buy", buy_command))
+    application.add_handler(CommandHandler("bulkbuy", bulk_buy_command))
+    application.add_handler(CommandHandler("stats", admin_stats))
     
     # Callback handlers
     application.add_handler(CallbackQueryHandler(handle_plan_choice, pattern="^(free_1h|1d|7d|15d|30d)$"))
@@ -489,28 +1952,114 @@ async def main():
     application.add_handler(CallbackQueryHandler(handle_login_prompt, pattern="^login_prompt$"))
     application.add_handler(CallbackQueryHandler(handle_number_purchase, pattern="^buy_"))
     application.add_handler(CallbackQueryHandler(check_messages, pattern="^check_msg_"))
+    application.add_handler(CallbackQueryHandler(message_page, pattern="^msg_page_"))
     application.add_handler(CallbackQueryHandler(number_info, pattern="^number_info_"))
     
     # Message handlers
     application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_twilio_credentials))
     
-    # Webhook setup
+    # Time every registered handler
+    for handlers in application.handlers.values():
+        for handler in handlers:
+            handler.callback = instrument(handler.callback)
+    return application
+
+def register_gauges():
+    # webhook() counts every update it queues in backlog; polled updates only show up in the queue
+    METRICS.gauge("bot_update_backlog", "Updates queued or being processed",
+                  callback=lambda: application.backlog if UPDATE_MODE == "webhook"
+                  else application.update_queue.qsize())
+    METRICS.gauge("bot_active_subscribers", "Users with a subscription entry",
+                  callback=lambda: USERS.subscribers)
+    METRICS.gauge("bot_stored_credentials", "Users with stored Twilio credentials",
+                  callback=lambda: USERS.credentials)
+    METRICS.gauge("bot_purchased_numbers", "Tracked purchased numbers",
+                  callback=lambda: USERS.numbers)
+    METRICS.gauge("bot_send_queue_depth", "Outbound Telegram messages waiting",
+                  callback=lambda: SEND_QUEUE.depth())
+    METRICS.gauge("bot_message_histories", "Numbers with a cached SMS history",
+                  callback=lambda: len(MESSAGE_HISTORY))
+    METRICS.gauge("bot_pending_number_releases", "Numbers waiting to be released on Twilio",
+                  callback=lambda: len(NUMBER_RELEASER))
+    METRICS.gauge("bot_deferred_actions", "Delayed UI edits waiting to run",
+                  callback=lambda: len(DEFERRED_ACTIONS))
+    for key in ('size', 'hits', 'misses', 'evictions'):
+        METRICS.gauge(f"bot_twilio_client_pool_{key}", f"Twilio client pool {key}",
+                      callback=partial(lambda k: TWILIO_CLIENTS.stats()[k], key))
+
+async def metrics_endpoint(request):
+    return web.Response(text=METRICS.render(), content_type="text/plain")
+
+async def main():
+    global application
+    
+    # Open the port first: health checks pass and webhook updates are
+    # buffered while the rest of the bot warms up
     app = web.Application()
-    app.router.add_post("/", webhook)
+    app.router.add_get(HEALTH_PATH, health)
+    if UPDATE_MODE == "webhook":
+        app.router.add_post(WEBHOOK_PATH, webhook)
+    app.router.add_post(SMS_WEBHOOK_PATH, sms_webhook)
+    app.router.add_get("/metrics", metrics_endpoint)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, "0.0.0.0", int(os.getenv("PORT", 8080)))
+    await site.start()
+    mark_startup("port_open")
+    
+    # Saved state loads on a thread while the Application is built and
+    # initialized (a getMe round trip to Telegram)
+    loop = asyncio.get_running_loop()
+    state_loaded = loop.run_in_executor(None, load_state)
+    application = build_application()
+    register_gauges()
+    await asyncio.gather(application.initialize(), state_loaded)
+    STATE_LOADED.set()
+    STATE_STORE.start()
+    SEND_QUEUE.start(application.bot)
 
-    async with application:
-        await application.start()
-        await application.updater.start_polling()
-        
-        # Start subscription checker task
-        asyncio.create_task(subscription_checker(application))
-        
-        runner = web.AppRunner(app)
-        await runner.setup()
-        site = web.TCPSite(runner, "0.0.0.0", int(os.getenv("PORT", 8080)))
-        await site.start()
-        logger.info("Bot is up and running...")
-        await asyncio.Event().wait()
+    # Render stops instances with SIGTERM; shut down cleanly so pending
+    # writes are flushed
+    stopping = asyncio.Event()
+    loop.add_signal_handler(signal.SIGTERM, stopping.set)
+    try:
+        async with application:
+            await application.start()
+            
+            # Start subscription checker task
+            asyncio.create_task(subscription_checker(application))
+            asyncio.create_task(NUMBER_INVENTORY.run())
+            asyncio.create_task(BALANCE_LEDGER.run())
+            asyncio.create_task(measure_event_loop_lag())
+            asyncio.create_task(DEFERRED_ACTIONS.run())
+            asyncio.create_task(NUMBER_RELEASER.run())
+            
+            try:
+                # Register the webhook only once updates can be processed
+                if UPDATE_MODE == "webhook":
+                    await application.bot.set_webhook(
+                        url=PUBLIC_URL + WEBHOOK_PATH,
+                        secret_token=WEBHOOK_SECRET,
+                        max_connections=100
+                    )
+                else:
+                    await application.updater.start_polling()
+                logger.info(f"Bot is up and running ({UPDATE_MODE})...")
+                mark_startup("ready")
+                
+                # Load the Twilio SDK in the background before the first request needs it
+                loop.run_in_executor(TWILIO_EXECUTOR, importlib.import_module, "twilio.rest")
+                await stopping.wait()
+            finally:
+                logger.info("Shutting down...")
+                if application.updater.running:
+                    await application.updater.stop()
+                await application.stop()
+    finally:
+        await runner.cleanup()
+        STATE_STORE.close()
+
+mark_startup("import")
 
 if __name__ == '__main__':
     asyncio.run(main())
@@ -0,0 +1,166 @@
+import logging
+import sqlite3
+import threading
+
+logger = logging.getLogger(__name__)
+
+# Table name -> columns, the first column is the primary key
+SCHEMA = {
+    "trial_users": ("user_id",),
+    "subscriptions": ("user_id", "expiry"),
+    "credentials": ("user_id", "sid", "token", "account_name", "balance"),
+    "purchased_numbers": ("user_id", "number", "sid", "purchase_date", "account_sid", "token"),
+    "bulk_numbers": ("number", "user_id", "sid", "purchase_date", "account_sid", "token"),
+    "number_releases": ("number_sid", "account_sid", "token", "number", "attempts"),
+    "bought_numbers": ("number_sid", "account_sid", "token", "number", "purchase_date"),
+}
+# Primary key types other than INTEGER
+KEY_TYPES = {
+    "bulk_numbers": "TEXT",
+    "number_releases": "TEXT",
+    "bought_numbers": "TEXT",
+}
+
+
+class StateStore:
+    """No-op backend, state only lives in memory (the old behaviour)."""
+
+    def load(self, table):
+        return []
+
+    def put(self, table, row):
+        pass
+
+    def delete(self, table, key):
+        pass
+
+    def start(self):
+        pass
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class SQLiteStore(StateStore):
+    """SQLite (WAL) backend with write-behind batching.
+
+    put() and delete() only record the latest operation per (table, key) in
+    memory; a writer thread commits everything pending in one transaction
+    every ``flush_interval`` seconds, or sooner once ``batch_size`` changes
+    are waiting. Handlers never wait on disk. A crash loses at most the
+    last unflushed batch, and SQLite replays the WAL on the next open.
+    """
+
+    def __init__(self, path, flush_interval=0.5, batch_size=5000):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self._pending = {}  # {(table, key): row or None for delete}
+        self._cond = threading.Condition()
+        self._write_lock = threading.Lock()
+        self._closed = False
+        self._thread = None
+
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        for table, columns in SCHEMA.items():
+            self._conn.execute(
+                f"CREATE TABLE IF NOT EXISTS {table} "
+                f"({columns[0]} {KEY_TYPES.get(table, 'INTEGER')} PRIMARY KEY"
+                f"{''.join(', ' + c for c in columns[1:])})"
+            )
+            # Columns added after a table was first created come back as NULL
+            existing = {row[1] for row in self._conn.execute(f"PRAGMA table_info({table})")}
+            for column in columns:
+                if column not in existing:
+                    self._conn.execute(f"ALTER TABLE {table} ADD COLUMN {column}")
+
+    def load(self, table):
+        return self._conn.execute(f"SELECT {', '.join(SCHEMA[table])} FROM {table}").fetchall()
+
+    def put(self, table, row):
+        self._enqueue((table, row[0]), tuple(row))
+
+    def delete(self, table, key):
+        self._enqueue((table, key), None)
+
+    def _enqueue(self, key, row):
+        with self._cond:
+            self._pending[key] = row
+            if len(self._pending) >= self.batch_size:
+                self._cond.notify()
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="state-writer", daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                if not self._closed and len(self._pending) < self.batch_size:
+                    self._cond.wait(timeout=self.flush_interval)
+                closed = self._closed
+            try:
+                self.flush()
+            except Exception as e:
+                logger.error(f"State flush failed: {e}")
+            if closed:
+                return
+
+    def flush(self):
+        with self._write_lock:
+            with self._cond:
+                pending, self._pending = self._pending, {}
+            if not pending:
+                return
+
+            upserts = {}
+            deletes = {}
+            for (table, key), row in pending.items():
+                if row is None:
+                    deletes.setdefault(table, []).append((key,))
+                else:
+                    upserts.setdefault(table, []).append(row)
+
+            try:
+                self._conn.execute("BEGIN")
+                for table, keys in deletes.items():
+                    self._conn.executemany(f"DELETE FROM {table} WHERE {SCHEMA[table][0]} = ?", keys)
+                for table, rows in upserts.items():
+                    placeholders = ", ".join("?" * len(SCHEMA[table]))
+                    self._conn.executemany(f"INSERT OR REPLACE INTO {table} VALUES ({placeholders})", rows)
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                # Put the batch back unless newer changes replaced it meanwhile
+                with self._cond:
+                    for key, row in pending.items():
+                        self._pending.setdefault(key, row)
+                raise
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+        if self._thread is not None:
+            self._thread.join()
+        else:
+            self.flush()
+        self._conn.close()
+
+
+BACKENDS = {
+    "memory": lambda path: StateStore(),
+    "sqlite": SQLiteStore,
+}
+
+
+def open_store(backend, path):
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown state backend: {backend}")
+    return BACKENDS[backend](path)
@@ -0,0 +1,111 @@
+class UserRecord:
+    """All per-user state in one fixed-layout object.
+
+    ``expiry`` and ``purchase_date`` are integer UTC epoch seconds, 0 when
+    unset; ``sid`` and ``number`` are None until the user logs in or buys.
+    ``number`` is the one replaced by each single purchase; numbers from
+    /bulkbuy live in ``bulk_numbers`` ({number: (number_sid, purchase_date,
+    account_sid, token)}), which stays None until the first bulk purchase.
+    Every number remembers the Twilio account it was bought on
+    (``number_account`` for the single one), since the user may log in to
+    another account later.
+    """
+
+    __slots__ = (
+        "user_id", "trial_used", "expiry",
+        "sid", "token", "account_name", "balance",
+        "number", "number_sid", "purchase_date", "number_account", "bulk_numbers",
+    )
+
+    def __init__(self, user_id):
+        self.user_id = user_id
+        self.trial_used = False
+        self.expiry = 0
+        self.sid = None
+        self.token = None
+        self.account_name = None
+        self.balance = 0.0
+        self.number = None
+        self.number_sid = None
+        self.purchase_date = 0
+        self.number_account = None  # (account_sid, token)
+        self.bulk_numbers = None
+
+    def lookup_number(self, number):
+        """Return (number_sid, purchase_date, account_sid, token) if the user owns ``number``."""
+        if number is not None and number == self.number:
+            return (self.number_sid, self.purchase_date) + self.number_account
+        if self.bulk_numbers:
+            return self.bulk_numbers.get(number)
+        return None
+
+    def number_accounts(self):
+        """(account_sid, token) of every account the user's numbers live on."""
+        accounts = {self.number_account} if self.number is not None else set()
+        for _, _, account_sid, token in (self.bulk_numbers or {}).values():
+            accounts.add((account_sid, token))
+        return accounts
+
+
+class UserStore:
+    """user_id -> UserRecord, with running counts for the metrics gauges.
+
+    Use the setters below rather than assigning expiry, credentials or
+    number fields directly so the counts stay right.
+    """
+
+    def __init__(self):
+        self._records = {}
+        self.subscribers = 0
+        self.credentials = 0
+        self.numbers = 0
+
+    def __len__(self):
+        return len(self._records)
+
+    def get(self, user_id):
+        return self._records.get(user_id)
+
+    def records(self):
+        return iter(self._records.values())
+
+    def record(self, user_id):
+        rec = self._records.get(user_id)
+        if rec is None:
+            rec = self._records[user_id] = UserRecord(user_id)
+        return rec
+
+    def is_active(self, user_id, now):
+        rec = self._records.get(user_id)
+        return rec is not None and rec.expiry > now
+
+    def subscriptions(self):
+        return ((rec.user_id, rec.expiry) for rec in self._records.values() if rec.expiry)
+
+    def set_expiry(self, user_id, expiry):
+        rec = self.record(user_id)
+        self.subscribers += bool(expiry) - bool(rec.expiry)
+        rec.expiry = expiry
+
+    def set_credentials(self, user_id, sid, token, account_name, balance):
+        rec = self.record(user_id)
+        self.credentials += rec.sid is None
+        rec.sid = sid
+        rec.token = token
+        rec.account_name = account_name
+        rec.balance = balance
+
+    def set_number(self, user_id, number, number_sid, purchase_date, account_sid, token):
+        rec = self.record(user_id)
+        self.numbers += rec.number is None
+        rec.number = number
+        rec.number_sid = number_sid
+        rec.purchase_date = purchase_date
+        rec.number_account = (account_sid, token)
+
+    def add_bulk_number(self, user_id, number, number_sid, purchase_date, account_sid, token):
+        rec = self.record(user_id)
+        if rec.bulk_numbers is None:
+            rec.bulk_numbers = {}
+        self.numbers += number not in rec.bulk_numbers
+        rec.bulk_numbers[number] = (number_sid, purchase_date, account_sid, token)